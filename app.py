@@ -1,60 +1,244 @@
-from dash import Dash, html, dcc
-from dash.dependencies import Input, Output, State
-
-import dash_auth
+from dash import Dash, html, dcc, ctx, no_update
+from dash.dependencies import Input, Output, State, ClientsideFunction
 
 # import additional packages
-import pandas as pd
-import pickle
+import os
+import random
+import logging
+import tempfile
+import threading
+from flask import abort
 
 # load the app modules
 import data
-from layout import base_layout, empty_tabs, filled_tabs
-from callbacks import display_poverty, display_click_data, update_progress_figure, get_testimonials, update_tab_layout
+from layout import base_layout, poverty_indicator_options, project_tab_labels, show_placeholder, base_style, \
+    create_description_tab, create_before_after_tab, create_testimonials_tab, create_progress_tab
+from images import ImageStore, load_image_data, register_image_route
+from cache import create_callback_cache, private_dir
+from bundle import bundle_datasets, read_output
+from serialize import RawJSON, dumps_figure, register_raw_json
+from compression import register_compression
+from auth import CredentialStore, load_secret_key, register_session_auth
+from registry import CountryRegistry
+from metrics import instrument, register_metrics
+from spatial import get_viewport
+from callbacks import display_poverty, patch_poverty, patch_markers, display_click_data, get_testimonials, update_progress_figure, \
+    update_tabs, get_progress_series
+
+logger = logging.getLogger(__name__)
 
 # ------------------------------- Define the global variables ----------------------------------------------------------
-# define the global data path
-data_pth = "Data/"
+# define the global data path, e.g. the synthetic data of the benchmarks is served with DASH_DATA_PATH
+data_pth = os.environ.get('DASH_DATA_PATH', "Data/")
 
 #----------------- Load external data ----------------------------------------------------------------------------------
 # define the data paths
-cntry_code = 'KHM' # cambodia country code
 pvty_pth = f'{data_pth}/wealth_data/subnational_mpi.csv'
-geo_pth = f'{data_pth}/geo_boundaries/gadm41_KHM_1.json'
+geo_tolerance = 0.005 # level of detail of the region boundaries in degrees, None for the full resolution
+alias_pth = f'{data_pth}/geo_boundaries/region_aliases.csv' # MPI names of regions spelled differently in GADM
+
+img_pth = f'{data_pth}/image_data.pkl'
+img_archive_pth = f'{data_pth}/image_data.imgarc' # built with `python build.py images`
+if os.path.exists(img_archive_pth):
+    img_pth = img_archive_pth
+
+# the data sources of every country, countries without projects only show their poverty data
+countries = {
+    'KHM': {
+        'geo_pth': f'{data_pth}/geo_boundaries/gadm41_KHM_1.json',
+        'project_pth': f'{data_pth}/cambodia_projects.csv',
+        'description_pth': f'{data_pth}/descriptions.csv',
+        'indicator_pth': f'{data_pth}/indicators.csv',
+        'testimonials_pth': f'{data_pth}/testimonials.csv',
+        'img_pth': img_pth
+    },
+    'SEN': {
+        'geo_pth': f'{data_pth}/geo_boundaries/gadm41_SEN_1.json'
+    }
+}
+default_cntry_code = 'KHM'
+max_loaded_countries = int(os.environ.get('DASH_MAX_COUNTRIES', 4))
+
+# parsed data is cached in a columnar snapshot, which is used as long as the source files did not change
+snapshot_pth = f'{data_pth}/snapshot'
+
+
+# the sources are polled every reload_interval seconds, changed datasets are reloaded without restarting. 0 disables it.
+reload_interval = float(os.environ.get('DASH_RELOAD_INTERVAL', 5))
+
+# with DASH_BUNDLE_PATH the callbacks are answered from an exported bundle (`python build.py export`) instead of Data/
+bundle_pth = os.environ.get('DASH_BUNDLE_PATH')
+
+
+def country_datasets(cntry_code):
+    if bundle_pth:
+        return bundle_datasets(bundle_pth, cntry_code, url_prefix=f'/images/{cntry_code}')
+    cntry_config = countries[cntry_code]
+    datasets = data.country_datasets(cntry_code, cntry_config, pvty_pth, geo_tolerance, snapshot_pth, alias_pth)
+
+    # the images are memory mapped (or loaded from the legacy pickle) and encoded once by the image store
+    img_pth = cntry_config.get('img_pth')
+    datasets['images'] = {
+        'sources': [img_pth] if img_pth else [],
+        'load': lambda previous: {'image_store': ImageStore(load_image_data(img_pth), img_format='PNG',
+                                                            url_prefix=f'/images/{cntry_code}')}
+    }
+    return datasets
+
+
+# the data of a country is loaded when it is requested for the first time, only the most recently used are kept
+registry = CountryRegistry(country_datasets, maxsize=max_loaded_countries)
+
+
+def get_image_store(cntry_code):
+    if cntry_code not in countries:
+        abort(404)
+    return registry.get(cntry_code)['image_store']
+
+
+# ------------------------------- Cache the callback results -----------------------------------------------------------
+# with DASH_BACKGROUND=1 the project tabs are loaded by a dash background callback: the request returns at once and the
+# browser polls for the result, which is computed in a process forked from the worker. The worker is free for other
+# users meanwhile. No broker is needed, the jobs are kept in a local diskcache (pip install dash[diskcache]).
+background_enabled = os.environ.get('DASH_BACKGROUND', '0') == '1'
+background_manager = None
+if background_enabled:
+    import diskcache
+    from dash import DiskcacheManager
+    # the jobs are pickled, by default they are kept in a directory only this user can access
+    background_manager = DiskcacheManager(diskcache.Cache(
+        os.environ.get('DASH_BACKGROUND_PATH') or private_dir(tempfile.gettempdir(), 'toy_dash_background')))
+
+# the results are cached by callback and inputs. With the sqlite backend (on a tmpfs) the cache is shared by all workers,
+# such that a result computed by one worker is served by all of them. Concurrent requests of the same result, e.g. many
+# users clicking the same project, compute it once. The background jobs only share their results through the sqlite
+# backend, hence it is the default with DASH_BACKGROUND=1.
+cache_size = int(os.environ.get('DASH_CACHE_SIZE', 1024))
+callback_cache = create_callback_cache(
+    backend=os.environ.get('DASH_CACHE_BACKEND', 'sqlite' if background_enabled else 'memory'),
+    db_pth=os.environ.get('DASH_CACHE_PATH'),
+    maxsize=cache_size,
+    ttl=float(os.environ.get('DASH_CACHE_TTL', 24 * 60 * 60))
+)
+
+# the cached results are keyed by the versions of the datasets they are computed from, hence a reload of a dataset
+# only invalidates the results depending on it
+def dataset_versions(*names):
+    return lambda cntry_code, *args: registry.versions(cntry_code, names)
+
+
+# the map figure of every country and poverty indicator is built once, with the projects visible in the initial view
+@callback_cache.memoize('display_poverty', version=dataset_versions('pvty', 'projects'))
+def map_figure(cntry_code, value):
+    country = registry.get(cntry_code)
+    viewport = get_viewport({'mapbox.center': country['center'], 'mapbox.zoom': country['zoom']})
+    markers, clusters = country['project_index'].cluster(*viewport)
+    fig = display_poverty(value, markers, country['pvty_data'], country['center'], country['zoom'], clusters)
+    return RawJSON(dumps_figure(fig.to_dict()))
+
+
+@callback_cache.memoize('display_click_data',
+                        version=dataset_versions('projects', 'descriptions', 'indicators', 'images'))
+def project_details(cntry_code, clicked_point_id):
+    country = registry.get(cntry_code)
+    return display_click_data(clicked_point_id, country['project_dict'], country['description_dict'],
+                              country['before_after_dict'], country['image_store'], country['indicator_dict'])
+
+
+@callback_cache.memoize('get_testimonials', version=dataset_versions('testimonials', 'images'))
+def testimonials(cntry_code, clicked_point_id):
+    country = registry.get(cntry_code)
+    return get_testimonials(clicked_point_id, country['testimonial_dict'], country['image_store'])
+
+
+# the progress figures are cached per (project_id, indicator)
+@callback_cache.memoize('update_progress_figure', version=dataset_versions('indicators'))
+def progress_figure(cntry_code, clicked_point_id, value):
+    country = registry.get(cntry_code)
+    return RawJSON(dumps_figure(update_progress_figure(value, clicked_point_id, country['indicator_dict']).to_dict()))
+
+
+@callback_cache.memoize('get_progress_series', version=dataset_versions('indicators'))
+def progress_series(cntry_code, clicked_point_id):
+    return get_progress_series(clicked_point_id, registry.get(cntry_code)['indicator_dict'])
 
-project_pth = f'{data_pth}/cambodia_projects.csv'
-description_pth = f'{data_pth}/descriptions.csv'
-indicator_pth = f'{data_pth}/indicators.csv'
-testimonials_pth = f'{data_pth}/testimonials.csv'
 
-img_pth = pth = f'{data_pth}/image_data.pkl'
+# the content of a project tab, only the opened tabs are loaded
+def load_tab(tab, cntry_code, clicked_point_id):
+    if tab == 'tab_3':
+        dropdown_options = project_details(cntry_code, clicked_point_id)[5]
+        return create_progress_tab(progress_figure(cntry_code, clicked_point_id, 'disbursement'), dropdown_options,
+                                   progress_series(cntry_code, clicked_point_id))
+    if tab == 'tab_2':
+        return create_testimonials_tab(testimonials(cntry_code, clicked_point_id))
+    proj_img, project_text, before_img, after_img, before_after_text, _ = project_details(cntry_code, clicked_point_id)
+    if tab == 'tab_1':
+        return create_before_after_tab(before_img, after_img, before_after_text)
+    return create_description_tab(proj_img, project_text)
 
-# load the data
-pvty_data = data.import_geo_poverty_data(pvty_pth,geo_pth,cntry_code)
 
-# load the project data
-project_df = data.import_project_data(project_pth)
+# the map figures and the tabs of an exported bundle are read as rendered, nothing is computed
+if bundle_pth:
+    def map_figure(cntry_code, value):
+        return read_output(registry.get(cntry_code)['bundle_pth'], 'map', f'{value}.json')
 
-# load the testimonial data
-testimonial_df = pd.read_csv(testimonials_pth)
-testimonial_dict = dict(zip(testimonial_df.testimonial_id, testimonial_df.testimonial))
+    def load_tab(tab, cntry_code, clicked_point_id):
+        return read_output(registry.get(cntry_code)['bundle_pth'], 'tabs', clicked_point_id, f'{tab}.json')
 
-# load the description data
-description_df = pd.read_csv(description_pth)
-description_dict = dict(zip(description_df.project_id, description_df.description))
-before_after_dict = dict(zip(description_df.project_id, description_df.before_after))
 
-# load the image data
-with(open(img_pth, 'rb')) as f:
-    image_data = pickle.load(f)
+for option in poverty_indicator_options:
+    map_figure(default_cntry_code, option['value'])
 
-# load the indicator data
-indicator_df = data.import_indicator_df(indicator_pth)
+
+# compute the results of every project ahead of the first clicks, e.g. after a deploy. The workers prewarm in a random
+# order each, with the sqlite backend they share the work. Every project takes 4 results, the projects beyond the cache
+# size would only evict the results warmed before, hence they are skipped. All workers warm the same projects.
+def prewarm(cntry_code=default_cntry_code):
+    country = registry.get(cntry_code)
+    for option in poverty_indicator_options:
+        map_figure(cntry_code, option['value'])
+    project_ids = list(country.get('project_dict', {}))
+    n_fitting = max((cache_size - len(poverty_indicator_options)) // 4, 0)
+    if len(project_ids) > n_fitting:
+        logger.warning('the cache (DASH_CACHE_SIZE=%d) holds the results of %d of the %d projects of %s, only these are '
+                       'prewarmed', cache_size, n_fitting, len(project_ids), cntry_code)
+        project_ids = project_ids[:n_fitting]
+    random.Random(os.getpid()).shuffle(project_ids)
+    for project_id in project_ids:
+        project_details(cntry_code, project_id)
+        testimonials(cntry_code, project_id)
+        progress_figure(cntry_code, project_id, 'disbursement')
+        progress_series(cntry_code, project_id)
+    return project_ids
+
+
+# with DASH_PREWARM=1 every worker prewarms the default country in a background thread, started on its first request
+prewarm_enabled = os.environ.get('DASH_PREWARM', '0') == '1' and not bundle_pth
+prewarm_pid = None
+
+
+def start_prewarm():
+    global prewarm_pid
+    if not prewarm_enabled or prewarm_pid == os.getpid():
+        return
+    prewarm_pid = os.getpid()
+
+    def run():
+        try:
+            logger.info('prewarmed %d projects', len(prewarm()))
+        except Exception:
+            logger.exception('prewarm failed')
+
+    threading.Thread(target=run, name='prewarm', daemon=True).start()
 
 # ------------------------------- define valid usernames ---------------------------------------------------------------
-valid_dict = {
-    'example_user': 'no_real_data_99'
-}
+# the users and their password hashes, added with `python build.py user <name>`
+credentials = CredentialStore(os.environ.get('DASH_CREDENTIALS_PATH', 'credentials.json'))
+
+# the session cookies are signed with DASH_SECRET_KEY, or with a key created once next to the credentials, shared by the
+# workers
+secret_key = os.environ.get('DASH_SECRET_KEY') or load_secret_key(os.environ.get(
+    'DASH_SECRET_KEY_PATH', os.path.join(os.path.dirname(os.path.abspath(credentials.credentials_pth)), 'secret.key')))
 
 # ------------------------------- Initialise the dashboard -------------------------------------------------------------
 
@@ -64,64 +248,99 @@ app = Dash(
     meta_tags=[
         {"name": "viewport", "content": "width=device-width, initial-scale=1.0"}
     ],
-    suppress_callback_exceptions=True
+    suppress_callback_exceptions=True,
+    background_callback_manager=background_manager
 )
-auth = dash_auth.BasicAuth(app, valid_dict)
 
 server = app.server
+
+# log in once on /login, afterwards only the signed session cookie is checked. The static files are served without it.
+# Prometheus scrapes /metrics with the bearer token DASH_METRICS_TOKEN instead.
+metrics_token = os.environ.get('DASH_METRICS_TOKEN')
+register_session_auth(server, credentials, secret_key,
+                      bearer_tokens={'/metrics': metrics_token} if metrics_token else None)
+
+# watch the data sources for changes, the watcher thread is started in every worker on its first request
+server.before_request(lambda: registry.watch(reload_interval))
+server.before_request(start_prewarm)
+
+# record the wall time, phases and response size of every callback, exposed for prometheus on /metrics
+register_metrics(server, url='/metrics')
+
+# compress the responses above DASH_COMPRESS_MIN_SIZE bytes and answer unchanged ones with 304 Not Modified
+register_compression(server, min_size=int(os.environ.get('DASH_COMPRESS_MIN_SIZE', 1024)))
+
+# the cached figures are serialized once, their bytes are spliced into the callback responses as they are
+register_raw_json(server)
+
+# serve the encoded images as cacheable static urls
+register_image_route(server, get_image_store, url_prefix='/images')
 # define the base layout
 app.layout = base_layout
 
 # ------------------------------- Define the callbacks -----------------------------------------------------------------:wq"
 
-# poverty map callback
-app.callback(
-    Output('the_map', 'figure'),
-    Input('poverty_indicator', 'value'),
-)(lambda value: display_poverty(value, project_df, pvty_data))
+# poverty map callback: the full figure (including the geometry) is only sent on the initial call and if the country
+# changes. Afterwards a change of the indicator only patches the colors of the choropleth and moving the map only patches
+# the projects and clusters within the viewport.
+def update_map(value, cntry_code, relayoutData):
+    country = registry.get(cntry_code)
+    if ctx.triggered_id == 'poverty_indicator':
+        return patch_poverty(value, country['pvty_data'])
+    if ctx.triggered_id == 'the_map':
+        viewport = get_viewport(relayoutData)
+        if viewport is None:
+            return no_update
+        return patch_markers(*country['project_index'].cluster(*viewport))
+    return map_figure(cntry_code, value)
 
-# ToDO: change the layout of the map points as soon as the user clicks on it
 
-# change the layout of the page as soon as the user clicks on a point
 app.callback(
-    Output('tabs', 'children'),
-    Input('the_map', 'clickData')
-)(lambda clickData: update_tab_layout(clickData, empty_tabs, filled_tabs))
+    Output('the_map', 'figure'),
+    [
+        Input('poverty_indicator', 'value'),
+        Input('country', 'value'),
+        Input('the_map', 'relayoutData')
+    ]
+)(instrument('update_map')(update_map))
 
+# ToDO: change the layout of the map points as soon as the user clicks on it
 
-# callback for the testimonial tab
+# a click on the map resolves the project and loads the open tab, the other tabs are loaded once they are opened
+tab_values = list(project_tab_labels)
 app.callback(
+    [Output(f'{value}_content', 'children') for value in tab_values] + [
+        Output('selected_project', 'data'),
+        Output('loaded_tabs', 'data')
+    ],
     [
-        Output('testimonial_img_1', 'src'),
-        Output('testimonial_text_1', 'children'),
-        Output('testimonial_img_2', 'src'),
-        Output('testimonial_text_2', 'children'),
-        Output('testimonial_img_3', 'src'),
-        Output('testimonial_text_3', 'children')
+        Input('the_map', 'clickData'),
+        Input('country', 'value'),
+        Input('project_tabs', 'value')
     ],
-    Input('the_map', 'clickData')
-)(lambda clickData: get_testimonials(clickData, testimonial_dict, image_data))
-
-
-app.callback(
     [
-        Output('project_img', 'src'),
-        Output('project_text', 'children'),
-        Output('before_img', 'src'),
-        Output('after_img', 'src'),
-        Output('before_after_text', 'children'),
-        Output('dropdown_options', 'options')
+        State('selected_project', 'data'),
+        State('loaded_tabs', 'data')
     ],
-    Input('the_map', 'clickData')
-)(lambda clickData: display_click_data(clickData, project_df, description_dict, before_after_dict, image_data, indicator_df))
+    background=background_enabled,
+    interval=250
+)(instrument('update_tabs')(
+    lambda clickData, cntry_code, active_tab, selected_project, loaded_tabs: update_tabs(
+        ctx.triggered_id, clickData, cntry_code, active_tab, selected_project, loaded_tabs, tab_values,
+        registry.get(cntry_code)['project_dict'], show_placeholder(base_style), load_tab
+    )
+))
 
-app.callback(
+# update the progress figure if another progress indicator is selected. The initial figure and the series of all
+# indicators come with the tab, the figure is switched in the browser without a request (assets/progress.js)
+app.clientside_callback(
+    ClientsideFunction(namespace='progress', function_name='switch_indicator'),
     Output('progress_fig', 'figure'),
-    [
-        Input('dropdown_options', 'value'),
-        Input('the_map', 'clickData')
-    ]
-)(lambda value, clickData: update_progress_figure(value, clickData, indicator_df))
+    Input('dropdown_options', 'value'),
+    State('progress_data', 'data'),
+    State('progress_fig', 'figure'),
+    prevent_initial_call=True
+)
 
 # ------------------------- run the dashboard ---------------------------------------------------------------------------
 if __name__ == '__main__':
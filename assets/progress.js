@@ -0,0 +1,25 @@
+// Clientside callbacks of the dashboard, loaded by dash from the assets folder.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    progress: {
+        // switch the progress figure to another indicator. The series of all indicators of the project come with the
+        // progress tab (see get_progress_series), only the y values, the goal line and the y label are replaced.
+        switch_indicator: function(value, series, figure) {
+            if (!value || !series || !figure || !series[value]) {
+                return window.dash_clientside.no_update;
+            }
+            const totals = series[value];
+            const goal = totals[totals.length - 1];
+
+            const data = figure.data.slice();
+            data[0] = Object.assign({}, data[0], {x: series.ts, y: totals});
+
+            const layout = Object.assign({}, figure.layout);
+            layout.shapes = (layout.shapes || []).map(shape => Object.assign({}, shape, {y0: goal, y1: goal}));
+            layout.annotations = (layout.annotations || []).map(annotation => Object.assign({}, annotation, {y: goal}));
+            layout.yaxis = Object.assign({}, layout.yaxis, {
+                title: Object.assign({}, (layout.yaxis || {}).title, {text: series.labels[value]})
+            });
+            return Object.assign({}, figure, {data: data, layout: layout});
+        }
+    }
+});
@@ -0,0 +1,150 @@
+import os
+import hmac
+import json
+import html
+import stat
+import time
+import secrets
+import datetime
+from urllib.parse import quote
+
+from flask import request, redirect, Response
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from cache import file_signature, atomic_write
+
+# paths served without a session: the login page and the static files of dash and of the assets folder
+public_prefixes = ('/login', '/assets/', '/_dash-component-suites/', '/_favicon.ico')
+
+# unknown users are checked against this hash, such that a login takes as long for unknown as for known users
+_unknown_user_hash = generate_password_hash(secrets.token_hex(16))
+
+login_page = '''<!DOCTYPE html>
+<html><head><title>Login</title><meta name="viewport" content="width=device-width, initial-scale=1.0"></head>
+<body style="font-family: sans-serif; display: flex; justify-content: center; margin-top: 15vh">
+<form method="post">
+<p style="color: #b00020">{error}</p>
+<p><input name="username" placeholder="User name" autocomplete="username" autofocus required></p>
+<p><input name="password" type="password" placeholder="Password" autocomplete="current-password" required></p>
+<p><button type="submit">Log in</button></p>
+</form></body></html>'''
+
+
+# ------------------------------- Credential store ---------------------------------------------------------------------
+# The users and the hashes of their passwords (werkzeug, scrypt by default) in a json file: {"users": {name: hash}}.
+# The file is read again once it changed, removed users lose their session with their next request.
+class CredentialStore:
+    def __init__(self, credentials_pth):
+        self.credentials_pth = credentials_pth
+        self._users = {}
+        self._signature = None
+
+    def users(self):
+        signature = file_signature([self.credentials_pth])
+        if signature != self._signature:
+            with open(self.credentials_pth) as f:
+                self._users = json.load(f)['users']
+            self._signature = signature
+        return self._users
+
+    def verify(self, user, password):
+        password_hash = self.users().get(user)
+        valid = check_password_hash(password_hash or _unknown_user_hash, password)
+        return valid and password_hash is not None
+
+    def set_password(self, user, password):
+        users = dict(self.users()) if os.path.exists(self.credentials_pth) else {}
+        users[user] = generate_password_hash(password)
+        with atomic_write(self.credentials_pth) as tmp_pth, open(tmp_pth, 'w') as f:
+            json.dump({'users': users}, f, indent=2)
+
+
+def load_secret_key(key_pth, timeout=5):
+    # the key signing the session cookies must be the same in all workers. The first worker creates the file, the others
+    # wait until it is written. Whoever can read or replace the key can sign a session of any user, hence a key file
+    # which is not private to the user of this process is refused.
+    try:
+        fd = os.open(key_pth, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+    except FileExistsError:
+        pass
+    else:
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+
+    deadline = time.time() + timeout
+    while True:
+        with open(os.open(key_pth, os.O_RDONLY | os.O_NOFOLLOW)) as f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o777 != 0o600:
+                raise PermissionError(f'{key_pth} is not a file owned by this user with mode 0600')
+            secret_key = f.read().strip()
+        if secret_key:
+            return secret_key
+        if time.time() > deadline:
+            raise ValueError(f'{key_pth} is empty')
+        time.sleep(0.05)
+
+
+# ------------------------------- Session authentication ---------------------------------------------------------------
+# The password is verified once on the login page, which issues a session cookie with the user signed by itsdangerous
+# (HMAC). Every other request only verifies the signature of the cookie, compared in constant time. The serializer is
+# built once, the cookie is neither decoded on the public paths nor signed again on every response.
+# Machine clients (e.g. prometheus on /metrics) cannot log in, bearer_tokens maps a path to a token which is accepted in
+# the Authorization header of its requests instead of a session.
+def register_session_auth(server, credentials, secret_key, lifetime=datetime.timedelta(hours=12),
+                          cookie_name='dash_session', bearer_tokens=None):
+    bearer_tokens = {path: f'Bearer {token}'.encode('utf-8') for path, token in (bearer_tokens or {}).items()}
+    serializer = URLSafeTimedSerializer(secret_key, salt='dash-session')
+    max_age = int(lifetime.total_seconds())
+
+    def session_user():
+        token = request.cookies.get(cookie_name)
+        if token is None:
+            return None
+        try:
+            return serializer.loads(token, max_age=max_age)
+        except BadSignature:
+            return None
+
+    def require_session():
+        if request.path.startswith(public_prefixes):
+            return None
+        bearer_token = bearer_tokens.get(request.path)
+        if bearer_token is not None and hmac.compare_digest(
+                request.headers.get('Authorization', '').encode('utf-8'), bearer_token):
+            return None
+        user = session_user()
+        if user is not None and user in credentials.users():
+            return None
+        # pages are redirected to the login, the requests of the dash renderer are rejected
+        if request.method == 'GET' and request.accept_mimetypes.accept_html:
+            return redirect(f'/login?next={quote(request.full_path.rstrip("?"))}')
+        return Response('Login required', 401)
+
+    def login():
+        error = ''
+        status = 200
+        if request.method == 'POST':
+            user = request.form.get('username', '')
+            if credentials.verify(user, request.form.get('password', '')):
+                next_url = request.args.get('next', '/')
+                # only redirect within the app
+                if not next_url.startswith('/') or next_url.startswith('//'):
+                    next_url = '/'
+                response = redirect(next_url)
+                response.set_cookie(cookie_name, serializer.dumps(user), max_age=max_age, httponly=True,
+                                    samesite='Lax', secure=request.is_secure)
+                return response
+            error = 'Invalid user name or password'
+            status = 401
+        return Response(login_page.format(error=html.escape(error)), status, mimetype='text/html')
+
+    def logout():
+        response = redirect('/login')
+        response.delete_cookie(cookie_name)
+        return response
+
+    server.before_request(require_session)
+    server.add_url_rule('/login', 'login', login, methods=['GET', 'POST'])
+    server.add_url_rule('/logout', 'logout', logout)
@@ -0,0 +1,155 @@
+# Benchmarks of the data loaders and the callback functions, called directly without the dash server.
+# Usage: python -m benchmarks.bench_callbacks --projects 5000
+#        python -m benchmarks.report benchmarks/results/callbacks-<base>.json benchmarks/results/callbacks-<new>.json
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+from plotly.io.json import to_json_plotly
+
+import data
+from PIL import Image
+
+from images import ImageStore, load_image_data, encode_image, encode_rendition
+from spatial import get_viewport
+from serialize import dumps_figure
+from callbacks import display_poverty, patch_poverty, patch_markers, display_click_data, get_testimonials, \
+    update_progress_figure
+from layout import poverty_indicator_options
+from benchmarks import synthetic
+from benchmarks.report import summarize, write_report, print_results
+
+indicator_values = [option['value'] for option in poverty_indicator_options]
+progress_values = ['disbursement', 'indicator_1', 'indicator_2']
+
+
+def measure(func, calls):
+    # wall time of every call, calls is a list of argument tuples
+    latencies = []
+    for args in calls:
+        start = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_serialization(name, fig, repeat):
+    # dash encoded the cached figure dicts on every response (to_json_plotly), the figures are serialized once now
+    fig_dict = fig.to_dict()
+    return {
+        f'{name}.to_json_plotly': summarize(measure(to_json_plotly, [(fig_dict,)] * repeat),
+                                            size_bytes=len(to_json_plotly(fig_dict))),
+        f'{name}.dumps_figure': summarize(measure(dumps_figure, [(fig_dict, False)] * repeat),
+                                          size_bytes=len(dumps_figure(fig_dict, False))),
+        f'{name}.dumps_figure.typed': summarize(measure(dumps_figure, [(fig_dict, True)] * repeat),
+                                                size_bytes=len(dumps_figure(fig_dict, True)))
+    }
+
+
+def bench_loaders(cntry_config, repeat, geo_tolerance):
+    # parse every dataset from its sources, then load it from a fresh snapshot
+    results = {}
+    with tempfile.TemporaryDirectory() as snapshot_pth:
+        for label, snapshot in [('parse', None), ('snapshot', snapshot_pth)]:
+            datasets = data.country_datasets(synthetic.cntry_code, cntry_config, cntry_config['pvty_pth'],
+                                             geo_tolerance, snapshot)
+            for name, dataset in datasets.items():
+                if snapshot:
+                    # the first load writes the snapshot
+                    dataset['load'](None)
+                latencies = measure(dataset['load'], [(None,)] * repeat)
+                results[f'load.{name}.{label}'] = summarize(latencies)
+    return results
+
+
+def bench_callbacks(cntry_config, repeat, geo_tolerance, seed):
+    rng = np.random.default_rng(seed)
+    datasets = data.country_datasets(synthetic.cntry_code, cntry_config, cntry_config['pvty_pth'], geo_tolerance)
+    country = {}
+    for dataset in datasets.values():
+        country.update(dataset['load'](None))
+    project_ids = list(country['project_dict'])
+    image_data = load_image_data(cntry_config['img_pth'])
+    image_store = ImageStore(image_data, url_prefix='/images/KHM')
+
+    results = {}
+    viewport = get_viewport({'mapbox.center': country['center'], 'mapbox.zoom': country['zoom']})
+    markers, clusters = country['project_index'].cluster(*viewport)
+    map_calls = [(value, markers, country['pvty_data'], country['center'], country['zoom'], clusters)
+                 for value in rng.choice(indicator_values, repeat)]
+    results['display_poverty'] = summarize(measure(display_poverty, map_calls))
+    fig = display_poverty(*map_calls[0])
+    results['display_poverty.to_json'] = summarize(measure(fig.to_json, [()] * repeat),
+                                                   size_bytes=len(fig.to_json()))
+    results.update(bench_serialization('display_poverty', fig, repeat))
+    results['patch_poverty'] = summarize(measure(
+        patch_poverty, [(value, country['pvty_data']) for value in rng.choice(indicator_values, repeat)]))
+
+    # viewports at random positions and zoom levels
+    relayouts = [{'mapbox.center': {'lat': rng.uniform(*synthetic.lat_range), 'lon': rng.uniform(*synthetic.lon_range)},
+                  'mapbox.zoom': rng.uniform(5, 12)} for _ in range(repeat)]
+    results['cluster'] = summarize(measure(
+        lambda relayout: country['project_index'].cluster(*get_viewport(relayout)), [(r,) for r in relayouts]))
+    results['patch_markers'] = summarize(measure(
+        patch_markers, [country['project_index'].cluster(*get_viewport(r)) for r in relayouts]))
+
+    # the first access of an image (rendition) encodes it, afterwards the encoded bytes are reused
+    image_ids = [(image_id,) for image_id in list(image_data)[:repeat]]
+    results['images.encode'] = summarize(measure(lambda image_id: encode_image(image_data[image_id]), image_ids))
+    for rendition in ['testimonial', 'before_after']:
+        for img_format in ['WEBP', 'JPEG']:
+            results[f'images.{rendition}.{img_format}'] = summarize(measure(
+                lambda image_id: encode_rendition(Image.fromarray(image_data[image_id]), rendition, img_format),
+                image_ids))
+
+    # the callbacks only reference the renditions by url, the version of the stored images is computed beforehand
+    clicked = [(project_id,) for project_id in rng.choice(project_ids, repeat)]
+    for project_id, in clicked:
+        for suffix in ['', '_before', '_after', '_testimonial_01', '_testimonial_02', '_testimonial_03']:
+            image_store.get_source_etag(project_id + suffix)
+    results['display_click_data'] = summarize(measure(
+        lambda project_id: display_click_data(project_id, country['project_dict'], country['description_dict'],
+                                              country['before_after_dict'], image_store, country['indicator_dict']),
+        clicked))
+    results['get_testimonials'] = summarize(measure(
+        lambda project_id: get_testimonials(project_id, country['testimonial_dict'], image_store), clicked))
+
+    progress_calls = [(value, project_id, country['indicator_dict'])
+                      for value, (project_id,) in zip(rng.choice(progress_values, repeat), clicked)]
+    results['update_progress_figure'] = summarize(measure(update_progress_figure, progress_calls))
+    fig = update_progress_figure(*progress_calls[0])
+    results['update_progress_figure.to_json'] = summarize(measure(fig.to_json, [()] * repeat),
+                                                          size_bytes=len(fig.to_json()))
+    results.update(bench_serialization('update_progress_figure', fig, repeat))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the data loaders and callbacks')
+    parser.add_argument('--data', help='synthetic data directory, generated into a temporary directory if not given')
+    synthetic.add_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=50, help='calls per callback benchmark')
+    parser.add_argument('--load-repeat', type=int, default=3, help='calls per loader benchmark')
+    parser.add_argument('--geo-tolerance', type=float, default=0.005)
+    parser.add_argument('--out', help='json report, benchmarks/results/callbacks-<commit>.json by default')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_pth:
+        if args.data:
+            cntry_config = synthetic.data_paths(args.data)
+        else:
+            cntry_config = synthetic.generate(os.path.join(tmp_pth, 'data'), args.projects, args.regions, args.images,
+                                              args.seed)
+        results = bench_loaders(cntry_config, args.load_repeat, args.geo_tolerance)
+        results.update(bench_callbacks(cntry_config, args.repeat, args.geo_tolerance, args.seed))
+
+    params = {key: value for key, value in vars(args).items() if key != 'out'}
+    out_pth = write_report(args.out, 'callbacks', params, results)
+    print_results(results)
+    print(f'wrote {out_pth}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# Requests, response bytes and worker time of a click on a project marker. The app is driven in-process through the
+# flask test client, with the requests the dash renderer sends for the callbacks on the_map.clickData.
+# Usage: python -m benchmarks.bench_click --projects 300
+#        python -m benchmarks.bench_click --app-path <checkout of another commit>
+# The app is imported from --app-path and run in a directory whose Data/ holds the synthetic data, hence also checkouts
+# from before DASH_DATA_PATH are measured on the same data.
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import tempfile
+import importlib
+import subprocess
+
+import pandas as pd
+
+from benchmarks import synthetic
+from benchmarks.report import summarize, write_report, print_results, results_pth
+
+repo_pth = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# values of the inputs which are not in the initial layout
+default_values = {('dropdown_options', 'value'): 'disbursement'}
+
+
+def layout_values(component, values=None):
+    # the initial value of every (id, property) of the layout
+    values = {} if values is None else values
+    if isinstance(component, list):
+        for child in component:
+            layout_values(child, values)
+    elif isinstance(component, dict) and 'props' in component:
+        props = component['props']
+        if 'id' in props:
+            values.update({(props['id'], prop): value for prop, value in props.items()})
+        layout_values(props.get('children'), values)
+    return values
+
+
+def output_spec(output):
+    # '..a.b...c.d..' for several outputs, 'a.b' for a single one
+    if not output.startswith('..'):
+        return dict(zip(['id', 'property'], output.rsplit('.', 1)))
+    return [dict(zip(['id', 'property'], part.rsplit('.', 1))) for part in output.strip('.').split('...')]
+
+
+def click_requests(client, headers):
+    # the request bodies of a click on project_id, the server side callbacks with the_map.clickData as input
+    dependencies = json.loads(client.get('/_dash-dependencies', headers=headers).data)
+    values = {**default_values, **layout_values(json.loads(client.get('/_dash-layout', headers=headers).data))}
+
+    def with_value(spec, click_data):
+        if (spec['id'], spec['property']) == ('the_map', 'clickData'):
+            return {**spec, 'value': click_data}
+        return {**spec, 'value': values.get((spec['id'], spec['property']))}
+
+    def make_bodies(project_id):
+        click_data = {'points': [{'curveNumber': 1, 'customdata': [project_id, '']}]}
+        return [{'output': dependency['output'], 'outputs': output_spec(dependency['output']),
+                 'inputs': [with_value(spec, click_data) for spec in dependency['inputs']],
+                 'state': [with_value(spec, click_data) for spec in dependency['state']],
+                 'changedPropIds': ['the_map.clickData']}
+                for dependency in dependencies
+                if not dependency.get('clientside_function') and
+                {'id': 'the_map', 'property': 'clickData'} in dependency['inputs']]
+    return make_bodies
+
+
+def bench_clicks(client, headers, project_ids):
+    make_bodies = click_requests(client, headers)
+    results = {}
+    # the first click of a project computes its panels, a repeated click is served from the callback caches
+    for name in ['first_click', 'repeated_click']:
+        latencies, cpu_times, n_bytes, n_requests = [], [], 0, 0
+        for project_id in project_ids:
+            start, start_cpu = time.perf_counter(), time.thread_time()
+            for body in make_bodies(project_id):
+                response = client.post('/_dash-update-component', json=body, headers=headers)
+                if response.status_code not in (200, 204):
+                    raise RuntimeError(f'{body["output"]}: status {response.status_code}')
+                n_bytes += len(response.data)
+                n_requests += 1
+            latencies.append(time.perf_counter() - start)
+            cpu_times.append(time.thread_time() - start_cpu)
+        results[name] = summarize(latencies, requests_per_click=n_requests / len(project_ids),
+                                  bytes_per_click=round(n_bytes / len(project_ids)),
+                                  cpu_mean_ms=round(sum(cpu_times) / len(cpu_times) * 1000, 3))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the requests and worker time of a project click')
+    synthetic.add_arguments(parser)
+    parser.add_argument('--app-path', default=repo_pth, help='checkout whose app is measured')
+    parser.add_argument('--user', default='example_user')
+    parser.add_argument('--password', default='no_real_data_99')
+    parser.add_argument('--out', help='json report, benchmarks/results/click-<commit>.json by default')
+    args = parser.parse_args()
+
+    app_pth = os.path.abspath(args.app_path)
+    with tempfile.TemporaryDirectory() as tmp_pth:
+        data_pth = os.path.join(tmp_pth, 'Data')
+        synthetic.generate(data_pth, args.projects, args.regions, args.images, args.seed)
+        os.environ['DASH_DATA_PATH'] = data_pth
+        os.environ.setdefault('DASH_CREDENTIALS_PATH', os.path.join(app_pth, 'credentials.json'))
+        os.chdir(tmp_pth)
+        sys.path.insert(0, app_pth)
+        app = importlib.import_module('app')
+
+        client = app.server.test_client()
+        # the session login, older checkouts use basic auth instead and answer the login with 404
+        client.post('/login', data={'username': args.user, 'password': args.password})
+        credentials = base64.b64encode(f'{args.user}:{args.password}'.encode()).decode()
+        headers = {'Authorization': f'Basic {credentials}'}
+        project_ids = pd.read_csv(os.path.join(data_pth, 'cambodia_projects.csv')).project_id.tolist()
+        results = bench_clicks(client, headers, project_ids)
+
+    # the report is named after the measured checkout
+    app_commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=app_pth).stdout.strip() or 'unknown'
+    out_pth = args.out
+    if out_pth is None:
+        os.makedirs(results_pth, exist_ok=True)
+        out_pth = os.path.join(results_pth, f'click-{app_commit}.json')
+    params = {key: value for key, value in vars(args).items() if key not in ['out', 'password']}
+    params['app_commit'] = app_commit
+    out_pth = write_report(out_pth, 'click', params, results)
+    print_results(results)
+    for name, result in results.items():
+        print(f'{name}: {result["requests_per_click"]:.0f} requests, {result["bytes_per_click"]} bytes, '
+              f'{result["cpu_mean_ms"]:.1f} ms cpu per click')
+    print(f'wrote {out_pth}')
+
+
+if __name__ == '__main__':
+    main()
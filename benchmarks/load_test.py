@@ -0,0 +1,226 @@
+# HTTP load test of the dash callbacks against a local gunicorn, serving the synthetic data.
+# Usage: python -m benchmarks.load_test --projects 5000 --workers 4 --concurrency 8 --duration 20
+#        python -m benchmarks.load_test --url http://127.0.0.1:8050 --data Data/   (against a running server)
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlsplit, urlencode
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import synthetic
+from benchmarks.report import summarize, write_report, print_results
+
+repo_pth = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+update_url = '/_dash-update-component'
+poll_interval = 0.25  # interval of the background callbacks in app.py
+
+
+# ------------------------------- Callback requests --------------------------------------------------------------------
+# the request bodies the dash renderer sends for the callbacks of app.py
+def map_body(value, cntry_code='KHM', relayout=None, changed='country.value'):
+    return {
+        'output': 'the_map.figure',
+        'outputs': {'id': 'the_map', 'property': 'figure'},
+        'inputs': [{'id': 'poverty_indicator', 'property': 'value', 'value': value},
+                   {'id': 'country', 'property': 'value', 'value': cntry_code},
+                   {'id': 'the_map', 'property': 'relayoutData', 'value': relayout}],
+        'changedPropIds': [changed]
+    }
+
+
+tab_values = ['tab_0', 'tab_1', 'tab_2', 'tab_3']
+
+
+def tabs_body(project_id, tab='tab_0', cntry_code='KHM', changed='the_map.clickData'):
+    # a click on a project loads the open tab, opening another tab loads this tab
+    return {
+        'output': ''.join(f'..{value}_content.children.' for value in tab_values) +
+                  '..selected_project.data...loaded_tabs.data..',
+        'outputs': [{'id': f'{value}_content', 'property': 'children'} for value in tab_values] +
+                   [{'id': 'selected_project', 'property': 'data'}, {'id': 'loaded_tabs', 'property': 'data'}],
+        'inputs': [{'id': 'the_map', 'property': 'clickData',
+                    'value': {'points': [{'curveNumber': 1, 'customdata': [project_id]}]}},
+                   {'id': 'country', 'property': 'value', 'value': cntry_code},
+                   {'id': 'project_tabs', 'property': 'value', 'value': tab}],
+        'state': [{'id': 'selected_project', 'property': 'data',
+                   'value': {'cntry_code': cntry_code, 'project_id': project_id}},
+                  {'id': 'loaded_tabs', 'property': 'data', 'value': ['tab_0']}],
+        'changedPropIds': [changed]
+    }
+
+
+indicator_values = ['no_indicator', 'mpi_region', 'hr_poor', 'hr_severe_poverty']
+
+# every scenario draws the body of its next request
+scenarios = {
+    'map': lambda rng, project_ids: map_body(rng.choice(indicator_values)),
+    'indicator': lambda rng, project_ids: map_body(rng.choice(indicator_values), changed='poverty_indicator.value'),
+    'viewport': lambda rng, project_ids: map_body(
+        'mpi_region', changed='the_map.relayoutData',
+        relayout={'mapbox.center': {'lat': rng.uniform(*synthetic.lat_range), 'lon': rng.uniform(*synthetic.lon_range)},
+                  'mapbox.zoom': rng.uniform(5, 12)}),
+    'click': lambda rng, project_ids: tabs_body(rng.choice(project_ids)),
+    'tab': lambda rng, project_ids: tabs_body(rng.choice(project_ids), rng.choice(tab_values[1:]),
+                                              changed='project_tabs.value')
+}
+
+
+# ------------------------------- Load generation ----------------------------------------------------------------------
+def run_client(url, headers, make_body, project_ids, deadline, seed, out):
+    # one client with a persistent connection, sending requests back to back until the deadline
+    rng = np.random.default_rng(seed)
+    parts = urlsplit(url)
+    con = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+    while time.perf_counter() < deadline:
+        body = json.dumps(make_body(rng, project_ids))
+        start = time.perf_counter()
+        try:
+            con.request('POST', update_url, body=body, headers=headers)
+            response = con.getresponse()
+            payload = response.read()
+            # a background callback (DASH_BACKGROUND=1) answers with its job, which is polled like the dash renderer does
+            job = json.loads(payload) if response.status == 200 and payload.startswith(b'{"cacheKey"') else None
+            while job is not None:
+                time.sleep(poll_interval)
+                con.request('POST', f'{update_url}?cacheKey={job["cacheKey"]}&job={job["job"]}', body=body,
+                            headers=headers)
+                response = con.getresponse()
+                payload = response.read()
+                if response.status != 200 or b'"response"' in payload:
+                    job = None
+        except (OSError, http.client.HTTPException):
+            con.close()
+            out['errors'] += 1
+            continue
+        out['latencies'].append(time.perf_counter() - start)
+        out['bytes'].append(len(payload))
+        if response.status != 200:
+            out['errors'] += 1
+    con.close()
+
+
+def run_scenario(url, headers, make_body, project_ids, concurrency, duration, seed):
+    outs = [{'latencies': [], 'bytes': [], 'errors': 0} for _ in range(concurrency)]
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    clients = [threading.Thread(target=run_client, args=(url, headers, make_body, project_ids, deadline, seed + i, out))
+               for i, out in enumerate(outs)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for out in outs for latency in out['latencies']]
+    sizes = [size for out in outs for size in out['bytes']]
+    return summarize(latencies, elapsed, errors=sum(out['errors'] for out in outs),
+                     mean_bytes=int(np.mean(sizes)) if sizes else 0)
+
+
+# ------------------------------- Local gunicorn -----------------------------------------------------------------------
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url, server, timeout=300):
+    # the app loads the data at import, poll the login page until the workers answer
+    parts = urlsplit(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError('gunicorn exited during startup')
+        try:
+            con = http.client.HTTPConnection(parts.hostname, parts.port, timeout=5)
+            con.request('GET', '/login')
+            if con.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f'{url} did not become ready within {timeout}s')
+
+
+def login(url, user, password):
+    # log in once, the clients send the session cookie with every request
+    parts = urlsplit(url)
+    con = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+    con.request('POST', '/login', body=urlencode({'username': user, 'password': password}),
+                headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    response = con.getresponse()
+    response.read()
+    if response.status != 302:
+        raise RuntimeError(f'login of {user} failed with status {response.status}')
+    return response.getheader('Set-Cookie').split(';', 1)[0]
+
+
+def start_gunicorn(data_pth, workers, threads, port, env=None):
+    env = {**os.environ, **(env or {}), 'DASH_DATA_PATH': os.path.abspath(data_pth)}
+    return subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--threads', str(threads),
+         '--bind', f'127.0.0.1:{port}', '--timeout', '300', 'app:server'],
+        cwd=repo_pth, env=env
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the dash callbacks over http')
+    parser.add_argument('--data', help='data directory, synthetic data is generated if not given')
+    synthetic.add_arguments(parser)
+    parser.add_argument('--url', help='url of a running server, a local gunicorn is started if not given')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=1, help='threads per gunicorn worker')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per scenario')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds per scenario before measuring')
+    parser.add_argument('--scenarios', nargs='+', default=list(scenarios), choices=list(scenarios))
+    parser.add_argument('--user', default='example_user')
+    parser.add_argument('--password', default='no_real_data_99')
+    parser.add_argument('--out', help='json report, benchmarks/results/load-<commit>.json by default')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_pth:
+        data_pth = args.data
+        if data_pth is None:
+            data_pth = os.path.join(tmp_pth, 'data')
+            synthetic.generate(data_pth, args.projects, args.regions, args.images, args.seed)
+        project_ids = pd.read_csv(os.path.join(data_pth, 'cambodia_projects.csv')).project_id.tolist()
+
+        server = None
+        url = args.url
+        if url is None:
+            port = free_port()
+            url = f'http://127.0.0.1:{port}'
+            server = start_gunicorn(data_pth, args.workers, args.threads, port)
+        try:
+            wait_ready(url, server)
+            headers = {'Content-Type': 'application/json', 'Cookie': login(url, args.user, args.password)}
+            results = {}
+            for name in args.scenarios:
+                if args.warmup:
+                    run_scenario(url, headers, scenarios[name], project_ids, args.concurrency, args.warmup, args.seed)
+                results[name] = run_scenario(url, headers, scenarios[name], project_ids, args.concurrency,
+                                             args.duration, args.seed)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    params = {key: value for key, value in vars(args).items() if key not in ['out', 'password']}
+    out_pth = write_report(args.out, 'load', params, results)
+    print_results(results)
+    print(f'wrote {out_pth}')
+
+
+if __name__ == '__main__':
+    main()
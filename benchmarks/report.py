@@ -0,0 +1,98 @@
+# Latency reports of the benchmarks, written as json such that the runs of two commits can be compared.
+# Usage: python -m benchmarks.report <base.json> <new.json>
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+
+import numpy as np
+
+
+def summarize(latencies, elapsed=None, **extra):
+    # latencies in seconds, reported in milliseconds. Throughput is per second of the elapsed (wall) time, which for
+    # concurrent clients is shorter than the sum of the latencies.
+    latencies = np.asarray(latencies, dtype=float)
+    if elapsed is None:
+        elapsed = latencies.sum()
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000 if len(latencies) else (np.nan,) * 3
+    return {
+        'n': int(len(latencies)),
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'mean_ms': round(float(latencies.mean()) * 1000, 3) if len(latencies) else None,
+        'p50_ms': round(float(p50), 3),
+        'p95_ms': round(float(p95), 3),
+        'p99_ms': round(float(p99), 3),
+        'max_ms': round(float(latencies.max()) * 1000, 3) if len(latencies) else None,
+        **extra
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# the reports are kept per commit by default
+results_pth = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def write_report(out_pth, kind, params, results):
+    commit = git_commit()
+    if out_pth is None:
+        os.makedirs(results_pth, exist_ok=True)
+        out_pth = os.path.join(results_pth, f'{kind}-{commit or "unknown"}.json')
+    report = {
+        'kind': kind,
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'params': params,
+        'results': results
+    }
+    with open(out_pth, 'w') as f:
+        json.dump(report, f, indent=2)
+    return out_pth
+
+
+def print_results(results, file=sys.stdout):
+    print(f'{"benchmark":<36}{"n":>7}{"ops/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}', file=file)
+    for name, result in results.items():
+        print(f'{name:<36}{result["n"]:>7}{result["throughput"] or 0:>10.1f}{result["p50_ms"]:>10.2f}'
+              f'{result["p95_ms"]:>10.2f}{result["p99_ms"]:>10.2f}', file=file)
+
+
+def compare(base, new, file=sys.stdout):
+    # relative change of the latencies and the throughput of every benchmark in both reports
+    print(f'{base["commit"]} -> {new["commit"]}', file=file)
+    print(f'{"benchmark":<36}{"p50":>10}{"p95":>10}{"p99":>10}{"ops/s":>10}', file=file)
+    for name, result in new['results'].items():
+        if name not in base['results']:
+            continue
+        old = base['results'][name]
+        changes = []
+        for key in ['p50_ms', 'p95_ms', 'p99_ms', 'throughput']:
+            changes.append(f'{(result[key] / old[key] - 1) * 100:+.1f}%' if old.get(key) and result.get(key) else '-')
+        print(f'{name:<36}' + ''.join(f'{change:>10}' for change in changes), file=file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark reports')
+    parser.add_argument('base')
+    parser.add_argument('new')
+    args = parser.parse_args()
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    compare(base, new)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+# Synthetic data in the layout of Data/, scaled to any number of projects, regions and images.
+# Usage: python -m benchmarks.synthetic --out /tmp/toy_dash_data --projects 5000 --regions 400 --images 200
+import os
+import json
+import pickle
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# the synthetic data is placed within the bounding box of Cambodia, such that the map view stays realistic
+cntry_code = 'KHM'
+lon_range = (102.3, 107.6)
+lat_range = (10.4, 14.7)
+
+words = ('canal rehabilitation irrigation road community rice farmers water village commune province seeds credit '
+         'households infrastructure resilience income access market training school health climate drainage').split()
+
+
+def random_text(rng, n_words):
+    return ' '.join(rng.choice(words, n_words)).capitalize() + '.'
+
+
+def generate_regions(n_regions, rng):
+    # a grid of rectangular regions covering the bounding box, with their MPI data
+    nx = int(np.ceil(np.sqrt(n_regions * (lon_range[1] - lon_range[0]) / (lat_range[1] - lat_range[0]))))
+    ny = int(np.ceil(n_regions / nx))
+    dx = (lon_range[1] - lon_range[0]) / nx
+    dy = (lat_range[1] - lat_range[0]) / ny
+
+    features = []
+    mpi_rows = []
+    for i in range(n_regions):
+        x0 = lon_range[0] + (i % nx) * dx
+        y0 = lat_range[0] + (i // nx) * dy
+        ring = [[x0, y0], [x0 + dx, y0], [x0 + dx, y0 + dy], [x0, y0 + dy], [x0, y0]]
+        name = f'Region {i:05d}'
+        features.append({
+            'type': 'Feature',
+            'properties': {'GID_1': f'{cntry_code}.{i + 1}_1', 'GID_0': cntry_code, 'COUNTRY': 'Cambodia',
+                           'NAME_1': name.replace(' ', ''), 'VARNAME_1': 'NA'},
+            'geometry': {'type': 'Polygon', 'coordinates': [ring]}
+        })
+        hr_poor = rng.uniform(5, 70)
+        mpi_rows.append({'iso_country_code': cntry_code, 'country': 'Cambodia', 'subnational_region': name,
+                         'mpi_region': round(hr_poor / 200, 3), 'hr_poor': round(hr_poor, 2),
+                         'hr_severe_poverty': round(hr_poor * rng.uniform(0.1, 0.5), 2)})
+    return {'type': 'FeatureCollection', 'name': f'gadm41_{cntry_code}_1', 'features': features}, pd.DataFrame(mpi_rows)
+
+
+def generate_projects(n_projects, rng):
+    starts = pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.integers(0, 8 * 12, n_projects) * 30, unit='D')
+    starts = starts.to_period('M').to_timestamp()
+    durations = rng.integers(12, 48, n_projects)
+    return pd.DataFrame({
+        'project_id': [f'proj_{i:05d}' for i in range(n_projects)],
+        'name': [f'Project {i}' for i in range(n_projects)],
+        'location': [f'Town {i % 997}' for i in range(n_projects)],
+        'region': [f'Region {i % 25}' for i in range(n_projects)],
+        'lat': rng.uniform(*lat_range, n_projects).round(6),
+        'lon': rng.uniform(*lon_range, n_projects).round(6),
+        'funding': rng.integers(1, 200, n_projects) * 100000,
+        'start': starts.strftime('%Y-%m-%d'),
+        'end': (starts + pd.to_timedelta(durations * 30, unit='D')).strftime('%Y-%m-%d'),
+        'months': durations
+    })
+
+
+def generate_indicators(project_df, rng):
+    # one row per project and month with the monthly progress of the indicators
+    n_rows = project_df.months.sum()
+    project_ids = np.repeat(project_df.project_id.values, project_df.months.values)
+    month = np.concatenate([np.arange(n) for n in project_df.months.values])
+    dates = (pd.to_datetime(np.repeat(project_df.start.values, project_df.months.values)) +
+             pd.to_timedelta(month * 31, unit='D')).to_period('M').to_timestamp()
+    return pd.DataFrame({
+        'project_id': project_ids,
+        'date': dates.strftime('%Y-%m-%d'),
+        'indicator_1': rng.integers(0, 500, n_rows),
+        'indicator_2': rng.integers(0, 50, n_rows),
+        'indicator_name_1': 'Canal meters constructed',
+        'indicator_name_2': 'Distributed seeds (in tons)',
+        'disbursement': rng.integers(0, 20, n_rows) * 10000,
+        'disbursement_description': np.where(month == 0, 'scoping', '')
+    })
+
+
+def generate_images(image_ids, n_images, rng, size=(120, 160)):
+    # a pool of n_images distinct images shared by all image ids. The pickle stores every distinct array once, the
+    # image store still encodes every id on its own. Smooth gradients with some noise compress like photos.
+    y, x = np.mgrid[0:size[0], 0:size[1]]
+    pool = []
+    for _ in range(max(n_images, 1)):
+        channels = [(rng.uniform(0, 1) * x + rng.uniform(0, 1) * y + rng.uniform(0, 255)) % 256 for _ in range(3)]
+        image = np.stack(channels, axis=-1) + rng.normal(0, 8, (*size, 3))
+        pool.append(image.clip(0, 255).astype(np.uint8))
+    return {image_id: pool[i % len(pool)] for i, image_id in enumerate(image_ids)}
+
+
+def generate(out_pth, n_projects=1000, n_regions=25, n_images=100, seed=0):
+    # writes a data directory with the layout of Data/, which app.py serves if DASH_DATA_PATH points to it
+    rng = np.random.default_rng(seed)
+    for sub_dir in ['wealth_data', 'geo_boundaries']:
+        os.makedirs(os.path.join(out_pth, sub_dir), exist_ok=True)
+
+    cntry_geojson, mpi_df = generate_regions(n_regions, rng)
+    with open(os.path.join(out_pth, 'geo_boundaries', f'gadm41_{cntry_code}_1.json'), 'w') as f:
+        json.dump(cntry_geojson, f)
+    mpi_df.to_csv(os.path.join(out_pth, 'wealth_data', 'subnational_mpi.csv'), index=False)
+    # the region names match exactly, the alias table is empty
+    pd.DataFrame(columns=['iso_country_code', 'GID_1', 'NAME_1', 'subnational_region']).to_csv(
+        os.path.join(out_pth, 'geo_boundaries', 'region_aliases.csv'), index=False)
+
+    project_df = generate_projects(n_projects, rng)
+    project_df.drop(columns='months').to_csv(os.path.join(out_pth, 'cambodia_projects.csv'), index=False)
+    generate_indicators(project_df, rng).to_csv(os.path.join(out_pth, 'indicators.csv'), index=False)
+
+    pd.DataFrame({
+        'project_id': project_df.project_id,
+        'description': [random_text(rng, 150) for _ in range(n_projects)],
+        'before_after': [random_text(rng, 80) for _ in range(n_projects)]
+    }).to_csv(os.path.join(out_pth, 'descriptions.csv'), index=False)
+
+    testimonial_ids = [f'{project_id}_testimonial_0{i}' for project_id in project_df.project_id for i in range(1, 4)]
+    pd.DataFrame({
+        'project_id': np.repeat(project_df.project_id.values, 3),
+        'testimonial_id': testimonial_ids,
+        'testimonial': [random_text(rng, 100) for _ in testimonial_ids]
+    }).to_csv(os.path.join(out_pth, 'testimonials.csv'), index=False)
+
+    image_ids = [image_id for project_id in project_df.project_id
+                 for image_id in [project_id, f'{project_id}_before', f'{project_id}_after']]
+    image_data = generate_images(image_ids + testimonial_ids, n_images, rng)
+    with open(os.path.join(out_pth, 'image_data.pkl'), 'wb') as f:
+        pickle.dump(image_data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return data_paths(out_pth)
+
+
+def data_paths(out_pth):
+    # the country config of a synthetic data directory
+    return {
+        'pvty_pth': os.path.join(out_pth, 'wealth_data', 'subnational_mpi.csv'),
+        'geo_pth': os.path.join(out_pth, 'geo_boundaries', f'gadm41_{cntry_code}_1.json'),
+        'project_pth': os.path.join(out_pth, 'cambodia_projects.csv'),
+        'description_pth': os.path.join(out_pth, 'descriptions.csv'),
+        'indicator_pth': os.path.join(out_pth, 'indicators.csv'),
+        'testimonials_pth': os.path.join(out_pth, 'testimonials.csv'),
+        'img_pth': os.path.join(out_pth, 'image_data.pkl')
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument('--projects', type=int, default=1000, help='number of projects')
+    parser.add_argument('--regions', type=int, default=25, help='number of regions')
+    parser.add_argument('--images', type=int, default=100, help='number of distinct images')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic dashboard data')
+    parser.add_argument('--out', required=True, help='data directory to write')
+    add_arguments(parser)
+    args = parser.parse_args()
+    generate(args.out, args.projects, args.regions, args.images, args.seed)
+    print(f'wrote {args.projects} projects, {args.regions} regions and {args.images} images to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
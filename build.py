@@ -0,0 +1,124 @@
+# Build steps that preprocess the raw data in Data/ into the formats served by the dashboard.
+# Usage: python build.py <step> [options]
+import os
+import getpass
+import argparse
+import importlib
+
+import data
+from images import convert_image_pickle
+from bundle import export_bundle
+from auth import CredentialStore
+
+# define the global data path
+data_pth = "Data/"
+
+
+def build_images(args):
+    n_images = convert_image_pickle(args.pickle, args.archive, img_format=args.format,
+                                    with_renditions=args.renditions)
+    print(f'wrote {n_images} images to {args.archive}')
+
+
+def build_geometry(args):
+    for geo_pth in args.geo:
+        for tolerance in args.tolerance:
+            out_pth = data.build_simplified_geo(geo_pth, tolerance, precision=args.precision)
+            print(f'simplified {geo_pth} with tolerance {tolerance}: {out_pth}')
+
+
+def build_snapshot(args):
+    # drop the old snapshot and load the app once, which parses all sources and writes a fresh snapshot
+    data.clear_snapshot(args.snapshot)
+    app = importlib.import_module('app')
+    for cntry_code in app.countries:
+        app.registry.get(cntry_code)
+    print(f'wrote snapshot to {args.snapshot}')
+
+
+def build_prewarm(args):
+    # fill the callback cache after a deploy, run with the cache settings of the server, e.g. DASH_CACHE_BACKEND=sqlite
+    app = importlib.import_module('app')
+    for cntry_code in args.countries or [app.default_cntry_code]:
+        print(f'prewarmed {len(app.prewarm(cntry_code))} projects of {cntry_code}')
+
+
+def build_export(args):
+    # render the outputs of all callbacks from the data into a static bundle, served with DASH_BUNDLE_PATH
+    app = importlib.import_module('app')
+    cntry_codes = args.countries or list(app.countries)
+    version_pth = export_bundle(
+        args.out, [app.registry.get(cntry_code) for cntry_code in cntry_codes],
+        {cntry_code: app.countries[cntry_code].get('img_pth') for cntry_code in cntry_codes},
+        [option['value'] for option in app.poverty_indicator_options], list(app.project_tab_labels),
+        app.map_figure, app.load_tab
+    )
+    print(f'exported {", ".join(cntry_codes)} to {version_pth}')
+
+
+def build_user(args):
+    # add a user or set a new password, the running workers pick up the changed file
+    password = args.password or getpass.getpass(f'password of {args.name}: ')
+    CredentialStore(args.credentials).set_password(args.name, password)
+    print(f'set the password of {args.name} in {args.credentials}')
+
+
+def build_mpi_partitions(args):
+    data.partition_mpi(args.mpi)
+    print(f'partitioned {args.mpi} by country')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Preprocess the dashboard data')
+    steps = parser.add_subparsers(dest='step', required=True)
+
+    # convert the image pickle into a memory mappable image archive
+    images_parser = steps.add_parser('images', help='convert image_data.pkl into an image archive')
+    images_parser.add_argument('--pickle', default=f'{data_pth}/image_data.pkl')
+    images_parser.add_argument('--archive', default=f'{data_pth}/image_data.imgarc')
+    images_parser.add_argument('--format', default='PNG', choices=['PNG', 'JPEG', 'WEBP'])
+    images_parser.add_argument('--renditions', action='store_true', help='precompute the renditions of all images')
+    images_parser.set_defaults(func=build_images)
+
+    # simplify and quantize the region boundaries at several levels of detail
+    geometry_parser = steps.add_parser('geometry', help='simplify the region boundaries')
+    geometry_parser.add_argument('--geo', nargs='+', default=[f'{data_pth}/geo_boundaries/gadm41_KHM_1.json',
+                                                              f'{data_pth}/geo_boundaries/gadm41_SEN_1.json'])
+    geometry_parser.add_argument('--tolerance', nargs='+', type=float, default=[0.001, 0.005, 0.01])
+    geometry_parser.add_argument('--precision', type=int, default=4, help='decimals kept of every coordinate')
+    geometry_parser.set_defaults(func=build_geometry)
+
+    # split the world wide MPI data into one file per country
+    mpi_parser = steps.add_parser('mpi', help='partition the MPI data by country')
+    mpi_parser.add_argument('--mpi', default=f'{data_pth}/wealth_data/subnational_mpi.csv')
+    mpi_parser.set_defaults(func=build_mpi_partitions)
+
+    # parse all data sources once and store them in the startup snapshot
+    snapshot_parser = steps.add_parser('snapshot', help='rebuild the startup snapshot of the parsed data')
+    snapshot_parser.add_argument('--snapshot', default=f'{data_pth}/snapshot')
+    snapshot_parser.set_defaults(func=build_snapshot)
+
+    # compute the cached callback results of every project
+    prewarm_parser = steps.add_parser('prewarm', help='fill the shared callback cache with the results of all projects')
+    prewarm_parser.add_argument('--countries', nargs='+')
+    prewarm_parser.set_defaults(func=build_prewarm)
+
+    # render all callback outputs into a static bundle
+    export_parser = steps.add_parser('export', help='export the rendered callback outputs into a static bundle')
+    export_parser.add_argument('--out', default=f'{data_pth}/export')
+    export_parser.add_argument('--countries', nargs='+')
+    export_parser.set_defaults(func=build_export)
+
+    # add a user to the credential file of the login
+    user_parser = steps.add_parser('user', help='add a user or change the password of a user')
+    user_parser.add_argument('name')
+    user_parser.add_argument('--password', help='asked for if not given')
+    user_parser.add_argument('--credentials', default=os.environ.get('DASH_CREDENTIALS_PATH', 'credentials.json'))
+    user_parser.set_defaults(func=build_user)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import os
+import json
+import shutil
+import hashlib
+import functools
+
+import pandas as pd
+from plotly.io.json import to_json_plotly
+
+from cache import atomic_write
+from serialize import RawJSON
+from images import ImageStore, ImageArchive, convert_image_pickle
+from spatial import GridIndex
+
+# ------------------------------- Static export ------------------------------------------------------------------------
+# A bundle holds the rendered outputs of the callbacks for every country, poverty indicator and project, such that the
+# read-only views are served from static files. Layout of a bundle:
+#   <out_pth>/current                                   name of the served version
+#   <out_pth>/<version>/manifest.json                   countries with their map view, indicators and projects
+#   <out_pth>/<version>/<cntry_code>/map/<indicator>.json       full map figure
+#   <out_pth>/<version>/<cntry_code>/tabs/<project_id>/<tab>.json   content of a project tab (dash component json)
+#   <out_pth>/<version>/<cntry_code>/poverty.parquet    indicators per region, the indicator patches are built from it
+#   <out_pth>/<version>/<cntry_code>/projects.parquet   projects, the markers in the viewport are clustered from it
+#   <out_pth>/<version>/<cntry_code>/images.imgarc      image archive with all renditions
+# The progress figure of every indicator is switched in the browser from the series in the progress tab, hence the tabs
+# cover all progress metrics. The version is a hash of the datasets the bundle was rendered from.
+
+
+def write_json(pth, obj):
+    os.makedirs(os.path.dirname(pth), exist_ok=True)
+    with open(pth, 'wb') as f:
+        f.write(obj.json_bytes if isinstance(obj, RawJSON) else to_json_plotly(obj).encode('utf-8'))
+
+
+def export_country(version_pth, country, img_pth, indicator_values, tab_values, render_map, render_tab):
+    cntry_code = country['cntry_code']
+    cntry_pth = os.path.join(version_pth, cntry_code)
+    for value in indicator_values:
+        write_json(os.path.join(cntry_pth, 'map', f'{value}.json'), render_map(cntry_code, value))
+    for project_id in country['project_dict']:
+        for tab in tab_values:
+            write_json(os.path.join(cntry_pth, 'tabs', project_id, f'{tab}.json'),
+                       render_tab(tab, cntry_code, project_id))
+
+    pd.DataFrame(country['pvty_data'].drop(columns='geometry')).to_parquet(
+        os.path.join(cntry_pth, 'poverty.parquet'), index=False)
+    country['project_df'].to_parquet(os.path.join(cntry_pth, 'projects.parquet'), index=False)
+    if img_pth and img_pth.endswith('.pkl'):
+        convert_image_pickle(img_pth, os.path.join(cntry_pth, 'images.imgarc'), with_renditions=True)
+    elif img_pth:
+        shutil.copyfile(img_pth, os.path.join(cntry_pth, 'images.imgarc'))
+
+    return {'center': country['center'], 'zoom': country['zoom'], 'indicators': list(indicator_values),
+            'projects': list(country['project_dict']), 'images': bool(img_pth)}
+
+
+def export_bundle(out_pth, countries, img_pths, indicator_values, tab_values, render_map, render_tab):
+    # countries are the loaded country dicts, render_map(cntry_code, value) and render_tab(tab, cntry_code, project_id)
+    # return the outputs of the callbacks. The bundle is written next to the served one and then made current.
+    versions = [(country['cntry_code'], sorted(country['versions'].items())) for country in countries]
+    version = hashlib.sha1(repr(versions).encode('utf-8')).hexdigest()[:12]
+    version_pth = os.path.join(out_pth, version)
+
+    manifest = {'version': version, 'tabs': list(tab_values), 'countries': {}}
+    with atomic_write(version_pth) as tmp_pth:
+        for country in countries:
+            manifest['countries'][country['cntry_code']] = export_country(
+                tmp_pth, country, img_pths.get(country['cntry_code']), indicator_values, tab_values, render_map,
+                render_tab)
+        write_json(os.path.join(tmp_pth, 'manifest.json'), manifest)
+        # a directory is only replaced if it is empty
+        shutil.rmtree(version_pth, ignore_errors=True)
+    with atomic_write(os.path.join(out_pth, 'current')) as tmp_pth, open(tmp_pth, 'w') as f:
+        f.write(version)
+    return version_pth
+
+
+# ------------------------------- Serving from a bundle ----------------------------------------------------------------
+def current_version_pth(bundle_pth):
+    # a bundle path is either a single version or a directory of versions with the current one named in `current`
+    current_pth = os.path.join(bundle_pth, 'current')
+    if not os.path.exists(current_pth):
+        return bundle_pth
+    with open(current_pth) as f:
+        return os.path.join(bundle_pth, f.read().strip())
+
+
+def bundle_datasets(bundle_pth, cntry_code, url_prefix):
+    # the data of a country served from a bundle, in place of the datasets of data.country_datasets. A new current
+    # version is picked up by the hot reload of the registry.
+    current_pth = os.path.join(bundle_pth, 'current')
+
+    def load(previous):
+        version_pth = current_version_pth(bundle_pth)
+        with open(os.path.join(version_pth, 'manifest.json')) as f:
+            manifest = json.load(f)['countries'][cntry_code]
+        cntry_pth = os.path.join(version_pth, cntry_code)
+        project_df = pd.read_parquet(os.path.join(cntry_pth, 'projects.parquet'))
+        img_pth = os.path.join(cntry_pth, 'images.imgarc')
+        return {
+            'bundle_pth': cntry_pth,
+            'pvty_data': pd.read_parquet(os.path.join(cntry_pth, 'poverty.parquet')),
+            'center': manifest['center'],
+            'zoom': manifest['zoom'],
+            'project_df': project_df,
+            'project_dict': dict.fromkeys(manifest['projects']),
+            'project_index': GridIndex(project_df),
+            'image_store': ImageStore(ImageArchive(img_pth) if manifest['images'] else {}, url_prefix=url_prefix)
+        }
+
+    sources = [current_pth] if os.path.exists(current_pth) else [os.path.join(bundle_pth, 'manifest.json')]
+    return {'bundle': {'sources': sources, 'load': load}}
+
+
+@functools.lru_cache(maxsize=4096)
+def read_output(cntry_pth, *parts):
+    # the rendered output at cntry_pth/parts..., the paths are versioned hence the outputs never change. The bytes are
+    # sent as they are.
+    with open(os.path.join(cntry_pth, *parts), 'rb') as f:
+        return RawJSON(f.read())
@@ -0,0 +1,283 @@
+import os
+import stat
+import time
+import pickle
+import sqlite3
+import shutil
+import hashlib
+import tempfile
+import functools
+import contextlib
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+
+from metrics import phase
+
+
+def file_signature(paths):
+    # cheap fingerprint of the source files, changes whenever one of the files is modified
+    signature = []
+    for pth in paths:
+        stat = os.stat(pth)
+        signature.append((pth, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+@contextlib.contextmanager
+def atomic_write(pth):
+    # yields a temporary path next to pth (a file or a directory) which replaces pth once the block completed. Readers,
+    # e.g. the other workers, never see a half written file and concurrent writers each write their own temporary path.
+    tmp_pth = f'{pth}.tmp{os.getpid()}-{threading.get_ident()}'
+    try:
+        yield tmp_pth
+        os.replace(tmp_pth, pth)
+    except BaseException:
+        if os.path.isdir(tmp_pth):
+            shutil.rmtree(tmp_pth, ignore_errors=True)
+        elif os.path.exists(tmp_pth):
+            os.remove(tmp_pth)
+        raise
+
+
+def private_dir(parent, name):
+    # a directory only the user of this process can access, for files at default paths in a world writable directory
+    # (e.g. /tmp). Any local user could create such a file first, the caches hold pickles which run code when loaded.
+    pth = os.path.join(parent, f'{name}-{os.getuid()}')
+    try:
+        os.mkdir(pth, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(pth)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(f'{pth} is not a directory owned by this user with mode 0700')
+    return pth
+
+
+# ------------------------------- Callback result cache ----------------------------------------------------------------
+# In-process backend: least recently used entries are dropped once maxsize is reached, entries expire after ttl seconds
+class MemoryBackend:
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def claim(self, key, timeout):
+        # concurrent computations of a key within the process are already deduplicated by the callback cache
+        return True
+
+    def release(self, key):
+        pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Backend shared by all worker processes of a machine. Put the database on a tmpfs (e.g. /dev/shm), such that it never
+# touches the disk. Values are pickled, the least recently used entries are dropped once maxsize is reached.
+class SQLiteBackend:
+    def __init__(self, db_pth, maxsize=1024, ttl=None, touch_interval=60):
+        self.db_pth = db_pth
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # a hit only writes its access time if the stored one is older than touch_interval seconds, such that most hits
+        # are plain reads. The least recently used entries are trimmed with this resolution.
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+        with self._connect() as con:
+            con.execute(
+                'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL, accessed REAL)'
+            )
+            con.execute('CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, expires REAL)')
+
+    def _connect(self):
+        # sqlite connections must not be shared between threads, nor with the processes forked from this one
+        con = getattr(self._local, 'con', None)
+        if con is None or self._local.pid != os.getpid():
+            con = sqlite3.connect(self.db_pth, timeout=10)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=OFF')
+            self._local.con = con
+            self._local.pid = os.getpid()
+        return con
+
+    def get(self, key):
+        con = self._connect()
+        now = time.time()
+        row = con.execute(
+            'SELECT value, accessed FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)', (key, now)
+        ).fetchone()
+        if row is None:
+            return False, None
+        if now - row[1] >= self.touch_interval:
+            with con:
+                con.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+        return True, pickle.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        expires = now + self.ttl if self.ttl else None
+        value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        con = self._connect()
+        with con:
+            con.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)', (key, value, expires, now))
+            con.execute('DELETE FROM cache WHERE expires IS NOT NULL AND expires < ?', (now,))
+            con.execute(
+                'DELETE FROM cache WHERE key IN '
+                '(SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.maxsize,)
+            )
+
+    def claim(self, key, timeout):
+        # claims the computation of a key for all workers. Returns False if another worker is computing it, a claim
+        # expires after timeout seconds such that the key is computed again if the claiming worker died.
+        now = time.time()
+        con = self._connect()
+        with con:
+            con.execute('DELETE FROM claims WHERE expires < ?', (now,))
+            return con.execute('INSERT OR IGNORE INTO claims VALUES (?, ?)', (key, now + timeout)).rowcount == 1
+
+    def release(self, key):
+        con = self._connect()
+        with con:
+            con.execute('DELETE FROM claims WHERE key = ?', (key,))
+
+    def clear(self):
+        con = self._connect()
+        with con:
+            con.execute('DELETE FROM cache')
+            con.execute('DELETE FROM claims')
+
+
+# Cache for the results of the callbacks, keyed by the callback name and its inputs. If source files are given, their
+# signature is part of the key, hence results computed from outdated data are never served. Alternatively a version
+# function returns the version of the data a result is computed from, e.g. the signatures of the loaded datasets.
+# Concurrent requests of the same key are computed once: within a process the other threads wait for the result of the
+# first one, with a shared backend the other workers poll the backend until the claiming worker stored the result.
+class CallbackCache:
+    def __init__(self, backend, claim_timeout=60, poll_interval=0.05):
+        self.backend = backend
+        self.claim_timeout = claim_timeout
+        self.poll_interval = poll_interval
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.waits = defaultdict(int)
+        self._flights = {}
+        self._lock = threading.Lock()
+        # a process forked while another thread computes a key (e.g. a background callback job) must not wait for it
+        os.register_at_fork(after_in_child=self._reset_flights)
+
+    def _reset_flights(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def make_key(self, name, args, sources=(), version=None):
+        # sources is either a list of files or a function returning the files for the given arguments
+        if callable(sources):
+            sources = sources(*args)
+        key = repr((name, args, file_signature(sources), version(*args) if version else None))
+        return f'{name}:{hashlib.sha1(key.encode("utf-8")).hexdigest()}'
+
+    def _wait_for_claim(self, key):
+        # another worker computes the key, wait until it stored the result or its claim expired
+        deadline = time.time() + self.claim_timeout
+        while time.time() < deadline:
+            time.sleep(self.poll_interval)
+            found, value = self.backend.get(key)
+            if found:
+                return True, value
+            if self.backend.claim(key, self.claim_timeout):
+                return False, None
+        self.backend.claim(key, self.claim_timeout)
+        return False, None
+
+    def _compute(self, name, key, func, args):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Future()
+        if not leader:
+            self.waits[name] += 1
+            with phase('wait'):
+                return flight.result()
+
+        try:
+            with phase('cache'):
+                claimed = self.backend.claim(key, self.claim_timeout)
+            if not claimed:
+                self.waits[name] += 1
+                with phase('wait'):
+                    found, value = self._wait_for_claim(key)
+                if found:
+                    flight.set_result(value)
+                    return value
+            try:
+                self.misses[name] += 1
+                value = func(*args)
+                with phase('cache'):
+                    self.backend.set(key, value)
+            finally:
+                self.backend.release(key)
+            flight.set_result(value)
+            return value
+        except BaseException as exc:
+            flight.set_exception(exc)
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+    def memoize(self, name, sources=(), version=None):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args):
+                with phase('cache'):
+                    key = self.make_key(name, args, sources, version)
+                    found, value = self.backend.get(key)
+                if found:
+                    self.hits[name] += 1
+                    return value
+                return self._compute(name, key, func, args)
+            return wrapper
+        return decorator
+
+    def stats(self):
+        names = sorted(set(self.hits) | set(self.misses) | set(self.waits))
+        return {name: {'hits': self.hits[name], 'misses': self.misses[name], 'waits': self.waits[name]}
+                for name in names}
+
+    def clear(self):
+        self.backend.clear()
+
+
+def create_callback_cache(backend='memory', db_pth=None, maxsize=1024, ttl=None):
+    if backend == 'memory':
+        return CallbackCache(MemoryBackend(maxsize=maxsize, ttl=ttl))
+    if backend == 'sqlite':
+        if db_pth is None:
+            tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            db_pth = os.path.join(private_dir(tmp_dir, 'toy_dash_callback_cache'), 'cache.sqlite')
+        return CallbackCache(SQLiteBackend(db_pth, maxsize=maxsize, ttl=ttl))
+    raise ValueError(f'unknown cache backend: {backend}')
@@ -1,10 +1,10 @@
 import numpy as np
 import pandas as pd
-from dash import html
+from dash import html, Patch, no_update
 import plotly.express as px
-from PIL import Image
-import io
-import base64
+import plotly.graph_objects as go
+
+from metrics import phase
 
 import warnings
 warnings.simplefilter("ignore", category=FutureWarning)
@@ -14,8 +14,21 @@ overall_background_color = '#161d2f'
 base_color = '#1d283c'
 
 
+# labels of the poverty indicators
+indicator_labels = {
+    'mpi_region': 'MPI',
+    'hr_poor': '% Poor',
+    'hr_severe_poverty': '% Severe poverty'
+}
+
+
+# the hover data of the projects, the first column is the custom data of a clicked project
+project_hover_cols = ['project_id', 'name', 'location', 'funding_format', 'start', 'end']
+
+
 # Define the callback function to deal with the map
-def display_poverty(value, project_df, khm_01):
+@phase('figure')
+def display_poverty(value, project_df, pvty_data, center={'lat': 12, 'lon': 105}, zoom=5, clusters=None):
     hover_template = (
         "<b>%{customdata[1]}</b><br>"
         "Town: %{customdata[2]}<br>"
@@ -37,10 +50,10 @@ def display_poverty(value, project_df, khm_01):
             lat='lat',
             lon='lon',
             hover_name='name',
-            hover_data=['project_id', 'name', 'location', 'funding_format', 'start', 'end'],
+            hover_data=project_hover_cols,
             custom_data=['project_id'],
-            center={'lat': 12, 'lon': 105},
-            zoom=5,
+            center=center,
+            zoom=zoom,
             mapbox_style=map_style
         )
     scatter_fig.update_traces(
@@ -55,28 +68,48 @@ def display_poverty(value, project_df, khm_01):
         )
     )
 
-    if value != 'no_indicator':
-        fig = px.choropleth_mapbox(
-            khm_01,
-            geojson=khm_01['geometry'],
-            locations=khm_01.index,
-            color=value,
-            mapbox_style=map_style,
-            opacity=.3,
-            center={'lat': 12, 'lon': 105},
-            zoom=5,
-            labels={
-                'mpi_region': 'MPI',
-                'hr_poor': '% Poor',
-            },
-            hover_data=['subnational_region', 'mpi_region', 'hr_poor', 'GID_0']
-        )
-        fig.update_traces(
-            hovertemplate=hover_template_choropleth
-        )
-        fig.add_trace(scatter_fig.data[0])
-    else:
-        fig = scatter_fig
+    # the choropleth is always the first trace and only hidden if no indicator is selected. Like this, switching the
+    # indicator only needs to patch the colors of the existing trace (see patch_poverty)
+    color = value if value != 'no_indicator' else 'mpi_region'
+    fig = px.choropleth_mapbox(
+        pvty_data,
+        geojson=pvty_data['geometry'],
+        locations=pvty_data.index,
+        color=color,
+        mapbox_style=map_style,
+        opacity=.3,
+        center=center,
+        zoom=zoom,
+        labels=indicator_labels,
+        hover_data=['subnational_region', 'mpi_region', 'hr_poor', 'GID_0']
+    )
+    fig.update_traces(
+        hovertemplate=hover_template_choropleth
+    )
+    fig.add_trace(scatter_fig.data[0])
+
+    # the clusters of projects, which are too close to each other to be shown individually at this zoom level
+    if clusters is None:
+        clusters = pd.DataFrame({'lat': [], 'lon': [], 'count': []})
+    fig.add_trace(go.Scattermapbox(
+        lat=clusters['lat'],
+        lon=clusters['lon'],
+        customdata=[[count] for count in clusters['count']],
+        mode='markers+text',
+        text=clusters['count'].astype(int).astype(str),
+        textfont=dict(color='white'),
+        marker=dict(color='red', size=cluster_marker_size(clusters['count']), opacity=.8),
+        hovertemplate="<b>%{customdata[0]} projects</b><br>Zoom in to see the projects<extra></extra>",
+        hoverlabel=dict(
+            bgcolor=base_color,
+            font=dict(color='white')
+        ),
+        showlegend=False
+    ))
+
+    if value == 'no_indicator':
+        fig.update_traces(visible=False, selector=dict(type='choroplethmapbox'))
+        fig.update_coloraxes(showscale=False)
 
     fig.update_layout(
         clickmode = 'event+select',
@@ -92,16 +125,72 @@ def display_poverty(value, project_df, khm_01):
     return fig
 
 
-# define a callback function to update the layout of the tabs once a point is clicked
-def update_tab_layout(clickData, empty_tabs, filled_tabs):
-    if clickData:
-        customdata = clickData['points'][0]['customdata']
-        if 'KHM' not in customdata:
-            return filled_tabs
-        else:
-            return empty_tabs
+# switch the indicator of an already displayed map, without sending the geometry again
+@phase('figure')
+def patch_poverty(value, pvty_data):
+    patch = Patch()
+    if value == 'no_indicator':
+        patch['data'][0]['visible'] = False
+        patch['layout']['coloraxis']['showscale'] = False
     else:
-        return empty_tabs
+        patch['data'][0]['visible'] = True
+        patch['data'][0]['z'] = pvty_data[value].tolist()
+        patch['layout']['coloraxis']['showscale'] = True
+        patch['layout']['coloraxis']['colorbar']['title']['text'] = indicator_labels[value]
+    return patch
+
+
+# get the project id of a clicked map point, None if nothing or no project (e.g. a region) was clicked
+def get_clicked_point_id(clickData, project_dict):
+    if not clickData:
+        return None
+    customdata = clickData['points'][0].get('customdata')
+    if not customdata or customdata[0] not in project_dict:
+        return None
+    return customdata[0]
+
+
+def cluster_marker_size(counts):
+    return (10 + 5 * np.log2(np.maximum(counts, 1))).tolist()
+
+
+# show only the projects and clusters within the current viewport of the map
+@phase('figure')
+def patch_markers(project_df, clusters):
+    patch = Patch()
+    patch['data'][1]['lat'] = project_df['lat'].tolist()
+    patch['data'][1]['lon'] = project_df['lon'].tolist()
+    patch['data'][1]['customdata'] = project_df[project_hover_cols].values.tolist()
+    patch['data'][2]['lat'] = clusters['lat'].tolist()
+    patch['data'][2]['lon'] = clusters['lon'].tolist()
+    patch['data'][2]['customdata'] = [[count] for count in clusters['count'].astype(int).tolist()]
+    patch['data'][2]['text'] = clusters['count'].astype(int).astype(str).tolist()
+    patch['data'][2]['marker']['size'] = cluster_marker_size(clusters['count'])
+    return patch
+
+
+# define a callback function to update the tabs once a point is clicked or another tab is opened. A click resolves the
+# project and loads only the content of the open tab, the other tabs are emptied and loaded once they are opened.
+# load_tab(tab, cntry_code, project_id) returns the (cached) content of a tab, bound to the data in app.py.
+# Returns the content of all tabs (no_update for unchanged ones), followed by the selected project and the loaded tabs.
+def update_tabs(triggered_id, clickData, cntry_code, active_tab, selected_project, loaded_tabs, tab_values, project_dict,
+                placeholder, load_tab):
+    if triggered_id == 'project_tabs':
+        # a tab was opened, its content is kept once loaded
+        if not selected_project or active_tab in loaded_tabs:
+            return [no_update] * len(tab_values) + [no_update, no_update]
+        contents = [no_update] * len(tab_values)
+        contents[tab_values.index(active_tab)] = load_tab(active_tab, selected_project['cntry_code'],
+                                                          selected_project['project_id'])
+        return contents + [no_update, loaded_tabs + [active_tab]]
+
+    clicked_point_id = get_clicked_point_id(clickData if triggered_id == 'the_map' else None, project_dict)
+    if clicked_point_id is None:
+        return [placeholder] * len(tab_values) + [None, []]
+    contents = [load_tab(value, cntry_code, clicked_point_id) if value == active_tab else []
+                for value in tab_values]
+    return contents + [{'cntry_code': cntry_code, 'project_id': clicked_point_id}, [active_tab]]
+
 
 def plot_static_image(image_data):
     height, width, _ = image_data.shape
@@ -114,18 +203,9 @@ def plot_static_image(image_data):
     return fig
 
 
-def get_img_src(image_data):
-    pil_img = Image.fromarray(image_data)
-    buff = io.BytesIO()
-    pil_img.save(buff, format="PNG")
-    encoded = base64.b64encode(buff.getvalue()).decode("utf-8")
-    return f"data:image/png;base64,{encoded}"
-
-
 # callback function to populate the testimonial tab
-def get_testimonials(clickData, testimonial_dict, image_data):
-
-    clicked_point_id = clickData['points'][0]['customdata'][0]
+@phase('lookup')
+def get_testimonials(clicked_point_id, testimonial_dict, image_store):
 
     # get the testimonial data
     out = []
@@ -134,7 +214,7 @@ def get_testimonials(clickData, testimonial_dict, image_data):
         # get the testimonial data
         testimonial_id = f'{clicked_point_id}_testimonial_0{i}'
         # first the image, then the text
-        out.append(get_img_src(image_data[testimonial_id]))
+        out.append(image_store.get_src(testimonial_id, 'testimonial'))
         out.append(testimonial_dict[testimonial_id])
 
     # return tuple
@@ -143,12 +223,10 @@ def get_testimonials(clickData, testimonial_dict, image_data):
 
 # Second callback function to deal with the interactive points
 
-def display_click_data(clickData, project_df, description_dict, before_after_dict, image_data, indicator_df):
-    # get the clicked point id
-    clicked_point_id = clickData['points'][0]['customdata'][0]
-
+@phase('lookup')
+def display_click_data(clicked_point_id, project_dict, description_dict, before_after_dict, image_store, indicator_dict):
     # get the project name
-    clicked_name = str(project_df.name[project_df.project_id == clicked_point_id].reset_index(drop=True)[0])
+    clicked_name = str(project_dict[clicked_point_id]['name'])
 
     # get the project description
     proj_des = description_dict[clicked_point_id]
@@ -161,21 +239,22 @@ def display_click_data(clickData, project_df, description_dict, before_after_dic
     before_after = before_after_dict[clicked_point_id]
     before_after_text = before_after
 
-    #------ get the images -------------
+    #------ get the images (renditions sized for the tabs, encoded once by the image store) -------------
     # get the proj img
-    proj_img = get_img_src(image_data[clicked_point_id])
+    proj_img = image_store.get_src(clicked_point_id, 'project')
 
     # get the before image
     before_id = clicked_point_id + '_before'
-    before_img = get_img_src(image_data[before_id])
+    before_img = image_store.get_src(before_id, 'before_after')
 
     # get the after image
     after_id = clicked_point_id + '_after'
-    after_img = get_img_src(image_data[after_id])
+    after_img = image_store.get_src(after_id, 'before_after')
 
     # get the labels of the dropdown options
-    indicator_1_name = indicator_df.indicator_name_1[indicator_df.project_id == clicked_point_id].values[0]
-    indicator_2_name = indicator_df.indicator_name_2[indicator_df.project_id == clicked_point_id].values[0]
+    indicator_data = indicator_dict[clicked_point_id]
+    indicator_1_name = indicator_data.indicator_name_1.iat[0]
+    indicator_2_name = indicator_data.indicator_name_2.iat[0]
 
     ##### add the different dropdown options
     dropdown_options = [
@@ -187,23 +266,21 @@ def display_click_data(clickData, project_df, description_dict, before_after_dic
     return proj_img, project_text, before_img, after_img, before_after_text, dropdown_options
 
 
-# Third callback function to generate the plot on project progress
-def update_progress_figure(value, clickData, indicator_df):
-
-    clicked_point_id = clickData['points'][0]['customdata'][0]
+# Third callback function to generate the plot on project progress. The figure only depends on the project and the
+# selected indicator, hence it is memoized per (project_id, value) in app.py
+@phase('figure')
+def update_progress_figure(value, clicked_point_id, indicator_dict):
 
-    # get the project data, the disbursement data and the indicator data
-    indicator_data = indicator_df[indicator_df.project_id == clicked_point_id].reset_index(drop=True)
-    indicator_data['Total'] = indicator_data[value].cumsum(axis=0)
-
-    indicator_data['Date'] = pd.to_datetime(indicator_data['ts'])
+    # get the project data, the disbursement data and the indicator data (the cumulative totals are precomputed)
+    indicator_data = indicator_dict[clicked_point_id]
+    total_col = f'{value}_total'
 
     # get the indicator goal (in a dirty way)
-    indicator_goal = list(indicator_data['Total'])[-1]
+    indicator_goal = indicator_data[total_col].iat[-1]
 
     # get the y label
-    ind_1_lab = indicator_data.indicator_name_1.values[0]
-    ind_2_lab = indicator_data.indicator_name_2.values[0]
+    ind_1_lab = indicator_data.indicator_name_1.iat[0]
+    ind_2_lab = indicator_data.indicator_name_2.iat[0]
 
     # define the y lab
     if '1' in value:
@@ -215,7 +292,7 @@ def update_progress_figure(value, clickData, indicator_df):
 
     x_lab = 'Date'
 
-    fig = px.line(indicator_data, 'Date', 'Total', hover_data = ['Total'])
+    fig = px.line(indicator_data, 'ts', total_col, labels={'ts': 'Date', total_col: 'Total'})
     fig.data[0].update(mode='markers+lines')
     fig.add_hline(y=indicator_goal, line_dash="dash", line_color="green", annotation_text=f"Project Goal",
                   annotation_position="top right")
@@ -230,3 +307,18 @@ def update_progress_figure(value, clickData, indicator_df):
         hovermode="x unified"
     )
     return fig
+
+
+# compact columnar series of a project, shipped once with the progress tab. Switching the progress indicator is done in
+# the browser (assets/progress.js), which only replaces the y values, the goal line and the label of the figure.
+def get_progress_series(clicked_point_id, indicator_dict):
+    indicator_data = indicator_dict[clicked_point_id]
+    series = {'ts': indicator_data.ts.dt.strftime('%Y-%m-%d').tolist()}
+    for value in ['disbursement', 'indicator_1', 'indicator_2']:
+        series[value] = indicator_data[f'{value}_total'].tolist()
+    series['labels'] = {
+        'disbursement': 'Disbursements',
+        'indicator_1': indicator_data.indicator_name_1.iat[0],
+        'indicator_2': indicator_data.indicator_name_2.iat[0]
+    }
+    return series
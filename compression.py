@@ -0,0 +1,115 @@
+import gzip
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import request
+
+from metrics import compression_seconds, compression_saved_bytes, current_callback
+
+try:
+    import brotli
+except ImportError:
+    # brotli is optional (pip install brotli), the responses are gzip compressed without it
+    brotli = None
+
+# compressed encodings (images, fonts) are sent as they are
+compressible_mimetypes = {'application/json', 'application/javascript', 'text/javascript', 'text/html', 'text/css',
+                          'text/plain', 'image/svg+xml'}
+
+
+# ------------------------------- Compression and conditional responses ------------------------------------------------
+# Every response to a GET or HEAD request gets a strong etag, the hash of its body, if it has none yet. A request whose
+# If-None-Match matches the etag is answered with 304 Not Modified. The POST requests of the callbacks are only
+# compressed, 304 is not allowed for them and browsers never revalidate them. Responses above min_size are compressed with brotli or gzip, whichever the client accepts.
+# The etag of a compressed response names its encoding, such that the representations never share an etag. The
+# compressed bytes of the most recent bodies are kept, hence the same response (e.g. the layout, a cached figure, the
+# javascript bundles) is only compressed once.
+class Compressor:
+    def __init__(self, min_size=1024, gzip_level=6, brotli_quality=5, max_static_size=1 << 22, maxsize=256):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        # files served from disk (e.g. the assets) up to this size are read to be compressed
+        self.max_static_size = max_static_size
+        self.maxsize = maxsize
+        self._compressed = OrderedDict()
+        self._lock = threading.Lock()
+
+    def accepted_encoding(self):
+        if brotli is not None and request.accept_encodings['br']:
+            return 'br'
+        if request.accept_encodings['gzip']:
+            return 'gzip'
+        return None
+
+    def compress(self, body, digest, encoding):
+        key = (digest, encoding)
+        with self._lock:
+            compressed = self._compressed.get(key)
+            if compressed is not None:
+                self._compressed.move_to_end(key)
+                return compressed
+
+        endpoint = current_callback() or request.endpoint or 'unknown'
+        start = time.thread_time()
+        if encoding == 'br':
+            compressed = brotli.compress(body, quality=self.brotli_quality)
+        else:
+            compressed = gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+        compression_seconds.observe((endpoint, encoding), time.thread_time() - start)
+        compression_saved_bytes.observe((endpoint, encoding), len(body) - len(compressed))
+
+        with self._lock:
+            self._compressed[key] = compressed
+            while len(self._compressed) > self.maxsize:
+                self._compressed.popitem(last=False)
+        return compressed
+
+    def finish_request(self, response):
+        if response.status_code != 200 or 'Content-Encoding' in response.headers:
+            return response
+        if response.direct_passthrough:
+            # a file sent from disk, only small compressible files are read
+            if (response.mimetype not in compressible_mimetypes or response.content_length is None or
+                    response.content_length > self.max_static_size):
+                return response
+            response.direct_passthrough = False
+
+        body = response.get_data()
+        encoding = None
+        if response.mimetype in compressible_mimetypes and len(body) >= self.min_size:
+            encoding = self.accepted_encoding()
+            response.vary.add('Accept-Encoding')
+        conditional = request.method in ('GET', 'HEAD')
+        if not conditional and not encoding:
+            return response
+
+        digest = hashlib.sha1(body).hexdigest()
+        if conditional:
+            etag, weak = response.get_etag()
+            if etag is None:
+                etag, weak = digest, False
+                if not response.cache_control.max_age:
+                    # revalidate with the etag instead of downloading again
+                    response.cache_control.no_cache = True
+            if encoding:
+                etag = f'{etag}-{encoding}'
+            response.set_etag(etag, weak)
+
+            if request.if_none_match.contains_weak(etag) if weak else request.if_none_match.contains(etag):
+                response.status_code = 304
+                response.set_data(b'')
+                return response
+        if encoding:
+            response.set_data(self.compress(body, digest, encoding))
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+def register_compression(server, **kwargs):
+    # register after register_metrics, flask runs the after_request hooks in reverse order and the metrics record the
+    # size of the compressed responses
+    compressor = Compressor(**kwargs)
+    server.after_request(compressor.finish_request)
+    return compressor
@@ -1,10 +1,22 @@
 import pandas as pd
+import io
+import os
 import json
+import logging
+import math
+import hashlib
 import pickle
+import warnings
+import shapely
 import geopandas as gpd
 from datetime import datetime
 
-def import_geo_poverty_data(pvty_pth, geo_pth, cntry_code='KHM'):
+from spatial import GridIndex
+from cache import atomic_write
+
+logger = logging.getLogger(__name__)
+
+def import_geo_poverty_data(pvty_pth, geo_pth, cntry_code='KHM', alias_pth=None):
     mpi_df = pd.read_csv(pvty_pth)
     mpi_df = mpi_df[mpi_df.iso_country_code == cntry_code].reset_index(drop=True)
 
@@ -13,8 +25,9 @@ def import_geo_poverty_data(pvty_pth, geo_pth, cntry_code='KHM'):
         cntry_geojson = json.load(f)
     geodata = gpd.GeoDataFrame.from_features(cntry_geojson['features'])
 
-    # assume that the subnational regions are in the same order as they are in mpi_df (i.e., alphabetical)
-    geodata['subnational_region'] = mpi_df['subnational_region']
+    # match the subnational regions of the MPI data to the boundaries by their names
+    aliases = load_region_aliases(alias_pth, cntry_code)
+    geodata['subnational_region'] = match_regions(geodata, mpi_df, aliases, cntry_code)
 
     # merge the poverty data to the shapefile
     pvty_data = pd.merge(geodata, mpi_df[['subnational_region', 'mpi_region', 'hr_poor', 'hr_severe_poverty']],
@@ -22,6 +35,54 @@ def import_geo_poverty_data(pvty_pth, geo_pth, cntry_code='KHM'):
 
     return pvty_data
 
+
+# ------------------------------- Region matching ----------------------------------------------------------------------
+def normalize_region_names(names):
+    # strip accents, case, spaces and punctuation, e.g. 'Kâmpóng Cham' -> 'kampongcham'
+    return (names.fillna('').str.normalize('NFKD').str.encode('ascii', 'ignore').str.decode('ascii')
+            .str.lower().str.replace(r'[^a-z0-9]', '', regex=True))
+
+
+def load_region_aliases(alias_pth, cntry_code):
+    # the alias table maps the GADM region id (GID_1) to the MPI name of regions whose spelling differs too much
+    if alias_pth is None or not os.path.exists(alias_pth):
+        return pd.DataFrame(columns=['GID_1', 'subnational_region'])
+    aliases = pd.read_csv(alias_pth)
+    return aliases.loc[aliases.iso_country_code == cntry_code, ['GID_1', 'subnational_region']]
+
+
+def match_regions(geodata, mpi_df, aliases, cntry_code=''):
+    # returns the MPI region name of every boundary (None if unmatched). The candidate keys of a boundary are, in order of
+    # priority: its alias, its GADM name and its GADM variant names. The first candidate matching an MPI region wins.
+    alias_keys = geodata[['GID_1']].merge(aliases, on='GID_1', how='inner')
+    alias_keys = pd.DataFrame({'GID_1': alias_keys.GID_1, 'key': alias_keys.subnational_region, 'priority': 0})
+    name_keys = pd.DataFrame({'GID_1': geodata.GID_1, 'key': geodata.NAME_1, 'priority': 1})
+    varnames = geodata[['GID_1']].assign(key=geodata.VARNAME_1.str.split('|')).explode('key')
+    varnames = varnames[varnames.key != 'NA']
+    var_keys = pd.DataFrame({'GID_1': varnames.GID_1, 'key': varnames.key, 'priority': 2})
+
+    candidates = pd.concat([alias_keys, name_keys, var_keys], ignore_index=True)
+    candidates['key'] = normalize_region_names(candidates['key'])
+
+    mpi_keys = pd.DataFrame({'key': normalize_region_names(mpi_df.subnational_region),
+                             'subnational_region': mpi_df.subnational_region})
+    mpi_keys = mpi_keys[mpi_keys.key != ''].drop_duplicates('key')
+
+    matches = (candidates.merge(mpi_keys, on='key', how='inner')
+               .sort_values('priority', kind='stable')
+               .drop_duplicates('GID_1'))
+    region_names = geodata[['GID_1']].merge(matches[['GID_1', 'subnational_region']], on='GID_1', how='left')
+
+    # report the regions which could not be matched, they are shown without poverty data
+    unmatched_geo = region_names.GID_1[region_names.subnational_region.isna()].tolist()
+    unmatched_mpi = sorted(set(mpi_df.subnational_region) - set(region_names.subnational_region.dropna()))
+    if unmatched_geo or unmatched_mpi:
+        warnings.warn(f'{cntry_code}: unmatched boundaries {unmatched_geo}, unmatched MPI regions {unmatched_mpi}. '
+                      f'Add them to the region alias table.')
+
+    return region_names.subnational_region.values
+
+
 def import_project_data(project_pth):
     project_df = pd.read_csv(project_pth)
     # format the funding
@@ -29,10 +90,408 @@ def import_project_data(project_pth):
 
     return project_df
 
-def import_indicator_df(indicator_pth):
-    indicator_df = pd.read_csv(indicator_pth)
-    indicator_df = indicator_df.loc[~indicator_df.project_id.isna(), :].reset_index(drop=True)
-    indicator_df['ts'] = pd.to_datetime(indicator_df['date'], format='%Y-%m-%d')
+# the progress indicators of a project
+indicator_cols = ['disbursement', 'indicator_1', 'indicator_2']
+# text columns, repeated on every row, which are stored as categoricals
+indicator_category_cols = ['project_id', 'indicator_name_1', 'indicator_name_2', 'disbursement_description']
+
+
+def downcast_numeric(values):
+    # store integral columns as the smallest integer type, all others as float32
+    if values.notna().all() and (values % 1 == 0).all():
+        return pd.to_numeric(values, downcast='integer')
+    return pd.to_numeric(values, downcast='float')
+
+
+def compact_indicator_chunk(chunk):
+    chunk = chunk.loc[~chunk.project_id.isna(), :]
+    compact = pd.DataFrame({col: chunk[col].astype('category') for col in indicator_category_cols})
+    compact['ts'] = pd.to_datetime(chunk['date'], format='%Y-%m-%d')
+    for col in indicator_cols:
+        compact[col] = downcast_numeric(chunk[col])
+    return compact
+
+
+def concat_indicator_chunks(chunks):
+    # the categories of the chunks differ, they are unified before concatenating, otherwise pandas falls back to objects
+    chunks = [chunk for chunk in chunks if len(chunk)] or chunks[:1]
+    for col in indicator_category_cols:
+        categories = pd.api.types.union_categoricals([chunk[col] for chunk in chunks], sort_categories=True).categories
+        chunks = [chunk.assign(**{col: chunk[col].cat.set_categories(categories)}) for chunk in chunks]
+    return pd.concat(chunks, ignore_index=True)
+
+
+def add_indicator_totals(indicator_df):
+    # sort the series of every project by date and precompute the cumulative totals
+    indicator_df = indicator_df.sort_values(['project_id', 'ts'], kind='stable').reset_index(drop=True)
+    for col in indicator_cols:
+        # the totals are summed in 64 bit, the downcast values could overflow otherwise
+        values = indicator_df[col].astype('float64' if indicator_df[col].dtype.kind == 'f' else 'int64')
+        indicator_df[f'{col}_total'] = values.groupby(indicator_df.project_id, sort=False, observed=True).cumsum()
+    return indicator_df
+
+
+def complete_rows_end(indicator_pth):
+    # the byte after the last newline of the file. A writer may be appending a row while the file is read, the row is
+    # ingested once it is complete.
+    with open(indicator_pth, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(end - (1 << 16), 0)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+    return 0
+
+
+class BoundedReader(io.RawIOBase):
+    # reads a binary file up to the byte offset end
+    def __init__(self, f, end):
+        self.f = f
+        self.end = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.f.read(max(min(len(buffer), self.end - self.f.tell()), 0))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def read_indicator_chunks(indicator_pth, offset=0, end=None, chunksize=100000):
+    # parse the indicator csv in chunks, from the byte offset up to the byte offset end (the header is always read from
+    # the first line)
+    with open(indicator_pth, 'rb') as f:
+        header = f.readline().decode('utf-8').strip().split(',')
+        if offset:
+            f.seek(offset)
+        if end is not None and f.tell() >= end:
+            return
+        rows = f if end is None else io.BufferedReader(BoundedReader(f, end))
+        for chunk in pd.read_csv(rows, names=header, header=None, chunksize=chunksize,
+                                 dtype={col: str for col in indicator_category_cols}):
+            yield compact_indicator_chunk(chunk)
+
+
+def indicator_source_state(indicator_pth, offset):
+    # the offset up to which the file was ingested and a hash of the header and the bytes before the offset, used to
+    # check that the file was only appended to since
+    with open(indicator_pth, 'rb') as f:
+        header = f.readline()
+        f.seek(max(offset - 4096, 0))
+        tail = f.read(min(offset, 4096))
+    return {'source_offset': offset, 'source_tail': hashlib.sha1(header + tail).hexdigest()}
+
+
+def import_indicator_df(indicator_pth, chunksize=100000):
+    offset = complete_rows_end(indicator_pth)
+    chunks = list(read_indicator_chunks(indicator_pth, end=offset, chunksize=chunksize))
+    indicator_df = add_indicator_totals(concat_indicator_chunks(chunks))
+    indicator_df.attrs.update(indicator_source_state(indicator_pth, offset))
+    return indicator_df
+
+
+def append_indicator_df(indicator_df, indicator_pth, chunksize=100000):
+    # ingest only the rows appended to the file since indicator_df was imported. Returns None if the file was changed
+    # otherwise, in which case it has to be imported again.
+    offset = indicator_df.attrs.get('source_offset')
+    if offset is None or os.path.getsize(indicator_pth) < offset:
+        return None
+    if indicator_source_state(indicator_pth, offset)['source_tail'] != indicator_df.attrs.get('source_tail'):
+        return None
+
+    new_offset = complete_rows_end(indicator_pth)
+    chunks = list(read_indicator_chunks(indicator_pth, offset=offset, end=new_offset, chunksize=chunksize))
+    if chunks:
+        columns = list(chunks[0].columns)
+        indicator_df = add_indicator_totals(concat_indicator_chunks([indicator_df[columns]] + chunks))
+    else:
+        indicator_df = indicator_df.copy()
+    indicator_df.attrs.update(indicator_source_state(indicator_pth, new_offset))
     return indicator_df
 
 
+# ------------------------------- Indexed data access ------------------------------------------------------------------
+# lookups by project id are done on these indices, instead of filtering the whole data frames on every click
+def index_projects(project_df):
+    # project records keyed by the project id
+    return {record['project_id']: record for record in project_df.to_dict('records')}
+
+
+def index_indicators(indicator_df):
+    # the (date sorted) indicator series of every project, keyed by the project id
+    return {project_id: series.reset_index(drop=True)
+            for project_id, series in indicator_df.groupby('project_id', sort=False, observed=True)}
+
+
+# ------------------------------- Geometry simplification --------------------------------------------------------------
+def quantize_coords(coords, precision):
+    # round all (nested) coordinates to a fixed number of decimals, shared vertices stay shared
+    if isinstance(coords[0], (int, float)):
+        return [round(c, precision) for c in coords]
+    return [quantize_coords(c, precision) for c in coords]
+
+
+def simplify_geojson(cntry_geojson, tolerance, precision=4):
+    geodata = gpd.GeoDataFrame.from_features(cntry_geojson['features'])
+
+    # simplify the regions as one coverage, such that the borders of neighbouring regions are simplified identically
+    # and no gaps or overlaps appear (shapely 2.1 or newer)
+    geometries = shapely.coverage_simplify(geodata.geometry.values, tolerance)
+
+    features = []
+    for feature, geometry in zip(cntry_geojson['features'], geometries):
+        geometry = shapely.geometry.mapping(geometry)
+        features.append({
+            'type': 'Feature',
+            'properties': feature['properties'],
+            'geometry': {
+                'type': geometry['type'],
+                'coordinates': quantize_coords(geometry['coordinates'], precision)
+            }
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def simplified_geo_pth(geo_pth, tolerance):
+    root, ext = os.path.splitext(geo_pth)
+    return f'{root}_simplified_{tolerance}{ext}'
+
+
+def build_simplified_geo(geo_pth, tolerance, precision=4):
+    with open(geo_pth) as f:
+        cntry_geojson = json.load(f)
+    simplified = simplify_geojson(cntry_geojson, tolerance, precision)
+
+    out_pth = simplified_geo_pth(geo_pth, tolerance)
+    with atomic_write(out_pth) as tmp_pth, open(tmp_pth, 'w') as f:
+        json.dump(simplified, f, separators=(',', ':'))
+    return out_pth
+
+
+def get_geo_lod(geo_pth, tolerance=None, precision=4):
+    # returns the path of the boundaries at the chosen level of detail, tolerance None means full resolution.
+    # The simplified file is (re)built if it is missing or older than the source file.
+    if tolerance is None:
+        return geo_pth
+    out_pth = simplified_geo_pth(geo_pth, tolerance)
+    if not os.path.exists(out_pth) or os.path.getmtime(out_pth) < os.path.getmtime(geo_pth):
+        try:
+            build_simplified_geo(geo_pth, tolerance, precision)
+        except OSError as e:
+            # e.g. a read-only data directory, the full resolution is served until `python build.py geometry` ran
+            logger.warning('could not write the simplified boundaries of %s: %s', geo_pth, e)
+            return geo_pth
+    return out_pth
+
+
+# ------------------------------- Startup snapshot ---------------------------------------------------------------------
+# The parsed data frames are written to a columnar snapshot (parquet, the geometries as GeoParquet WKB blobs), which
+# workers load instead of parsing the source files again. A snapshot is used as long as it is fresh, i.e. the mtime and
+# size of all its source files are unchanged, or if they changed, their content hash is still the same.
+# The version of the snapshot format and of the loaders, snapshots of another version are parsed again. Bump it whenever
+# a loader returns something else, e.g. other columns, dtypes or attrs.
+snapshot_version = 2
+
+
+def file_sha256(pth):
+    sha = hashlib.sha256()
+    with open(pth, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def snapshot_sources(sources):
+    out = []
+    for pth in sources:
+        stat = os.stat(pth)
+        out.append({'pth': pth, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': file_sha256(pth)})
+    return out
+
+
+def snapshot_is_fresh(manifest, sources):
+    if manifest.get('version') != snapshot_version:
+        return False
+    if [source['pth'] for source in manifest['sources']] != list(sources):
+        return False
+    for source in manifest['sources']:
+        stat = os.stat(source['pth'])
+        if stat.st_mtime_ns == source['mtime_ns'] and stat.st_size == source['size']:
+            continue
+        if stat.st_size != source['size'] or file_sha256(source['pth']) != source['sha256']:
+            return False
+    return True
+
+
+def load_snapshot(name, sources, snapshot_pth):
+    manifest_pth = os.path.join(snapshot_pth, f'{name}.json')
+    if not os.path.exists(manifest_pth):
+        return None
+    with open(manifest_pth) as f:
+        manifest = json.load(f)
+    if not snapshot_is_fresh(manifest, sources):
+        return None
+
+    frame_pth = os.path.join(snapshot_pth, f'{name}.parquet')
+    if manifest['kind'] == 'geo':
+        return gpd.read_parquet(frame_pth)
+    return pd.read_parquet(frame_pth)
+
+
+def write_snapshot(name, df, sources, snapshot_pth):
+    os.makedirs(snapshot_pth, exist_ok=True)
+    manifest = {
+        'version': snapshot_version,
+        'kind': 'geo' if isinstance(df, gpd.GeoDataFrame) else 'frame',
+        'sources': snapshot_sources(sources)
+    }
+
+    # the other workers never read a half written snapshot, the manifest is replaced last
+    frame_pth = os.path.join(snapshot_pth, f'{name}.parquet')
+    manifest_pth = os.path.join(snapshot_pth, f'{name}.json')
+    with atomic_write(frame_pth) as tmp_pth:
+        df.to_parquet(tmp_pth, index=False)
+    with atomic_write(manifest_pth) as tmp_pth, open(tmp_pth, 'w') as f:
+        json.dump(manifest, f)
+
+
+def cached_load(name, loader, sources, snapshot_pth=None):
+    # load a data frame from its snapshot if it is fresh, otherwise parse the sources and write a new snapshot
+    if snapshot_pth is None:
+        return loader()
+    df = load_snapshot(name, sources, snapshot_pth)
+    if df is None:
+        df = loader()
+        try:
+            write_snapshot(name, df, sources, snapshot_pth)
+        except OSError as e:
+            # e.g. a read-only data directory, the sources are parsed again until `python build.py snapshot` ran
+            logger.warning('could not write the snapshot of %s: %s', name, e)
+    return df
+
+
+def clear_snapshot(snapshot_pth):
+    if not os.path.isdir(snapshot_pth):
+        return
+    for file_name in os.listdir(snapshot_pth):
+        if file_name.endswith('.json') or '.parquet' in file_name:
+            os.remove(os.path.join(snapshot_pth, file_name))
+
+
+# ------------------------------- Per country data ---------------------------------------------------------------------
+# columns of the project data, used for countries without any projects
+project_cols = ['project_id', 'name', 'location', 'region', 'lat', 'lon', 'funding', 'start', 'end', 'funding_format']
+
+
+def mpi_partition_pth(pvty_pth, cntry_code):
+    return os.path.join(os.path.dirname(pvty_pth), 'mpi', f'{cntry_code}.csv')
+
+
+def partition_mpi(pvty_pth):
+    # split the world wide MPI data into one file per country, such that loading a country does not parse the world
+    mpi_df = pd.read_csv(pvty_pth)
+    os.makedirs(os.path.dirname(mpi_partition_pth(pvty_pth, '')), exist_ok=True)
+    for cntry_code, cntry_df in mpi_df.groupby('iso_country_code'):
+        # workers starting at the same time partition concurrently, none of them may read a half written partition
+        partition_pth = mpi_partition_pth(pvty_pth, cntry_code)
+        with atomic_write(partition_pth) as tmp_pth:
+            cntry_df.to_csv(tmp_pth, index=False)
+
+
+def get_mpi_partition(pvty_pth, cntry_code):
+    # returns the MPI partition of a country, all partitions are (re)built if they are missing or outdated
+    partition_pth = mpi_partition_pth(pvty_pth, cntry_code)
+    if not os.path.exists(partition_pth) or os.path.getmtime(partition_pth) < os.path.getmtime(pvty_pth):
+        try:
+            partition_mpi(pvty_pth)
+        except OSError as e:
+            # e.g. a read-only data directory, the world wide file is parsed until `python build.py mpi` ran
+            logger.warning('could not partition %s: %s', pvty_pth, e)
+            return pvty_pth
+    if not os.path.exists(partition_pth):
+        # no MPI data of this country
+        return pvty_pth
+    return partition_pth
+
+
+def get_map_view(pvty_data):
+    # center and zoom of the map, such that the whole country is visible
+    min_lon, min_lat, max_lon, max_lat = pvty_data.total_bounds
+    center = {'lat': (min_lat + max_lat) / 2, 'lon': (min_lon + max_lon) / 2}
+    zoom = math.log2(360 / max(max_lon - min_lon, max_lat - min_lat)) - 1
+    return center, round(zoom, 1)
+
+
+def country_datasets(cntry_code, cntry_config, pvty_pth, geo_tolerance=None, snapshot_pth=None, alias_pth=None):
+    # the datasets of a country, each with its source files and a loader returning the entries it adds to the country.
+    # A dataset is reloaded on its own once one of its sources changes, the loader gets the current data of the country
+    # (None on the first load). Countries without projects only come with their poverty data.
+    geo_pth = cntry_config['geo_pth']
+    project_pth = cntry_config.get('project_pth')
+    description_pth = cntry_config.get('description_pth')
+    indicator_pth = cntry_config.get('indicator_pth')
+    testimonials_pth = cntry_config.get('testimonials_pth')
+
+    def load_poverty(previous):
+        pvty_data = cached_load(
+            f'pvty_{cntry_code}_{geo_tolerance}',
+            lambda: import_geo_poverty_data(get_mpi_partition(pvty_pth, cntry_code),
+                                            get_geo_lod(geo_pth, geo_tolerance), cntry_code, alias_pth),
+            pvty_sources, snapshot_pth
+        )
+        center, zoom = get_map_view(pvty_data)
+        return {'pvty_data': pvty_data, 'center': center, 'zoom': zoom}
+
+    def load_projects(previous):
+        if project_pth:
+            project_df = cached_load(f'projects_{cntry_code}', lambda: import_project_data(project_pth), [project_pth],
+                                     snapshot_pth)
+        else:
+            project_df = pd.DataFrame(columns=project_cols)
+        return {'project_df': project_df, 'project_dict': index_projects(project_df), 'project_index': GridIndex(project_df)}
+
+    def load_testimonials(previous):
+        testimonial_dict = {}
+        if testimonials_pth:
+            testimonial_df = cached_load(f'testimonials_{cntry_code}', lambda: pd.read_csv(testimonials_pth),
+                                         [testimonials_pth], snapshot_pth)
+            testimonial_dict = dict(zip(testimonial_df.testimonial_id, testimonial_df.testimonial))
+        return {'testimonial_dict': testimonial_dict}
+
+    def load_descriptions(previous):
+        description_dict = {}
+        before_after_dict = {}
+        if description_pth:
+            description_df = cached_load(f'descriptions_{cntry_code}', lambda: pd.read_csv(description_pth),
+                                         [description_pth], snapshot_pth)
+            description_dict = dict(zip(description_df.project_id, description_df.description))
+            before_after_dict = dict(zip(description_df.project_id, description_df.before_after))
+        return {'description_dict': description_dict, 'before_after_dict': before_after_dict}
+
+    def load_indicators(previous):
+        if not indicator_pth:
+            return {'indicator_df': None, 'indicator_dict': {}}
+
+        def parse():
+            # rows appended to the file are ingested on top of the current data, any other change is imported again
+            if previous is not None and previous.get('indicator_df') is not None:
+                indicator_df = append_indicator_df(previous['indicator_df'], indicator_pth)
+                if indicator_df is not None:
+                    return indicator_df
+            return import_indicator_df(indicator_pth)
+
+        indicator_df = cached_load(f'indicators_{cntry_code}', parse, [indicator_pth], snapshot_pth)
+        return {'indicator_df': indicator_df, 'indicator_dict': index_indicators(indicator_df)}
+
+    pvty_sources = [pth for pth in [pvty_pth, geo_pth, alias_pth] if pth]
+    return {
+        'pvty': {'sources': pvty_sources, 'load': load_poverty},
+        'projects': {'sources': [project_pth] if project_pth else [], 'load': load_projects},
+        'testimonials': {'sources': [testimonials_pth] if testimonials_pth else [], 'load': load_testimonials},
+        'descriptions': {'sources': [description_pth] if description_pth else [], 'load': load_descriptions},
+        'indicators': {'sources': [indicator_pth] if indicator_pth else [], 'load': load_indicators}
+    }
@@ -0,0 +1,307 @@
+import io
+import os
+import json
+import mmap
+import pickle
+import struct
+import base64
+import hashlib
+import threading
+
+from PIL import Image
+from flask import request, abort, Response
+
+from metrics import phase
+from cache import atomic_write
+
+# mime types of the supported encodings
+img_mimetypes = {
+    'PNG': 'image/png',
+    'JPEG': 'image/jpeg',
+    'WEBP': 'image/webp'
+}
+
+
+def encode_image(image_data, img_format='PNG', quality=85):
+    # encode a raw RGB(A) array into compressed image bytes
+    pil_img = Image.fromarray(image_data)
+    if img_format == 'JPEG' and pil_img.mode != 'RGB':
+        pil_img = pil_img.convert('RGB')
+    buff = io.BytesIO()
+    if img_format == 'PNG':
+        pil_img.save(buff, format=img_format, optimize=True)
+    else:
+        pil_img.save(buff, format=img_format, quality=quality)
+    return buff.getvalue()
+
+
+# ------------------------------- Renditions ---------------------------------------------------------------------------
+# Renditions of the images per target component. The height is the displayed css height at a pixel density of 2,
+# images are never upscaled. The photos are sent as WEBP, or as JPEG to browsers which do not accept WEBP.
+renditions = {
+    'testimonial': {'height': 200, 'quality': 75},
+    'project': {'height': 400, 'quality': 80},
+    'before_after': {'height': 600, 'quality': 80}
+}
+rendition_formats = ['WEBP', 'JPEG']
+
+
+def encode_rendition(pil_img, rendition, img_format):
+    spec = renditions[rendition]
+    if pil_img.height > spec['height']:
+        width = max(round(pil_img.width * spec['height'] / pil_img.height), 1)
+        pil_img = pil_img.resize((width, spec['height']), Image.LANCZOS)
+    if pil_img.mode != 'RGB':
+        pil_img = pil_img.convert('RGB')
+    buff = io.BytesIO()
+    if img_format == 'JPEG':
+        pil_img.save(buff, format=img_format, quality=spec['quality'], optimize=True, progressive=True)
+    else:
+        pil_img.save(buff, format=img_format, quality=spec['quality'], method=4)
+    return buff.getvalue()
+
+
+def rendition_key(image_id, rendition, img_format):
+    return f'{image_id}@{rendition}.{img_format}'
+
+
+# ------------------------------- Image archive --------------------------------------------------------------------------
+# Layout of an image archive on disk:
+#   8 bytes magic | 8 bytes index length (little endian) | json index | contiguous encoded image blobs
+# the index maps every image id to the [offset, length, etag] of its blob, offsets are relative to the blob section.
+# Precomputed renditions are indexed the same way, keyed by rendition_key.
+archive_magic = b'IMGARC01'
+archive_header = struct.Struct('<8sQ')
+
+
+def convert_image_pickle(pkl_pth, archive_pth, img_format='PNG', with_renditions=False):
+    # convert the pickled dict of raw arrays into an image archive, optionally with all renditions precomputed
+    with open(pkl_pth, 'rb') as f:
+        image_data = pickle.load(f)
+
+    index = {}
+    rendition_index = {}
+    blobs = []
+    offset = 0
+
+    def add_blob(index, key, img_bytes):
+        nonlocal offset
+        index[key] = [offset, len(img_bytes), hashlib.sha1(img_bytes).hexdigest()]
+        blobs.append(img_bytes)
+        offset += len(img_bytes)
+
+    for image_id, array in image_data.items():
+        add_blob(index, image_id, encode_image(array, img_format))
+        if with_renditions:
+            pil_img = Image.fromarray(array)
+            for rendition in renditions:
+                for rendition_format in rendition_formats:
+                    add_blob(rendition_index, rendition_key(image_id, rendition, rendition_format),
+                             encode_rendition(pil_img, rendition, rendition_format))
+
+    index_bytes = json.dumps({'format': img_format, 'images': index, 'renditions': rendition_index}).encode('utf-8')
+
+    # running workers never see a half written archive
+    with atomic_write(archive_pth) as tmp_pth, open(tmp_pth, 'wb') as f:
+        f.write(archive_header.pack(archive_magic, len(index_bytes)))
+        f.write(index_bytes)
+        for img_bytes in blobs:
+            f.write(img_bytes)
+    return len(index)
+
+
+# Read-only, memory mapped view on an image archive. All workers map the same file, hence the OS page cache is shared
+# and only the pages of the requested images are ever read from disk.
+class ImageArchive:
+    def __init__(self, archive_pth):
+        self.archive_pth = archive_pth
+        with open(archive_pth, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, index_len = archive_header.unpack_from(self._mmap, 0)
+        if magic != archive_magic:
+            raise ValueError(f'{archive_pth} is not an image archive')
+        index_start = archive_header.size
+        index = json.loads(self._mmap[index_start:index_start + index_len])
+
+        self.img_format = index['format']
+        self.index = index['images']
+        self.rendition_index = index.get('renditions', {})
+        self._blob_start = index_start + index_len
+
+    def __contains__(self, image_id):
+        return image_id in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def _get_blob(self, offset, length):
+        start = self._blob_start + offset
+        return self._mmap[start:start + length]
+
+    def get_bytes(self, image_id):
+        offset, length, etag = self.index[image_id]
+        return self._get_blob(offset, length), etag
+
+    def get_rendition(self, image_id, rendition, img_format):
+        # returns None if the rendition was not precomputed
+        entry = self.rendition_index.get(rendition_key(image_id, rendition, img_format))
+        if entry is None:
+            return None
+        offset, length, etag = entry
+        return self._get_blob(offset, length), etag
+
+    def close(self):
+        self._mmap.close()
+
+
+# ------------------------------- Image store ----------------------------------------------------------------------------
+# Store that encodes every image exactly once and serves the encoded bytes afterwards. The images either come from a
+# dict of raw arrays (legacy pickle) or from an image archive, in which case they are already encoded. The renditions
+# are encoded on first use as well, unless the archive comes with them.
+class ImageStore:
+    def __init__(self, image_data, img_format='PNG', url_prefix=None):
+        self.image_data = image_data
+        if isinstance(image_data, ImageArchive):
+            img_format = image_data.img_format
+        self.img_format = img_format
+        self.mimetype = img_mimetypes[img_format]
+        # if a url prefix is set, the images are referenced by url instead of inlined as data uri
+        self.url_prefix = url_prefix
+        self._encoded = {}
+        self._renditions = {}
+        self._source_etags = {}
+        self._data_uris = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, image_id):
+        return image_id in self.image_data
+
+    @phase('image')
+    def get_bytes(self, image_id):
+        # returns the encoded bytes and their etag, encoding the image on first use
+        if isinstance(self.image_data, ImageArchive):
+            return self.image_data.get_bytes(image_id)
+        encoded = self._encoded.get(image_id)
+        if encoded is None:
+            img_bytes = encode_image(self.image_data[image_id], self.img_format)
+            etag = hashlib.sha1(img_bytes).hexdigest()
+            encoded = (img_bytes, etag)
+            with self._lock:
+                self._encoded[image_id] = encoded
+        return encoded
+
+    @phase('image')
+    def get_rendition(self, image_id, rendition, img_format):
+        # returns the bytes and etag of a rendition, encoding it on first use
+        key = (image_id, rendition, img_format)
+        encoded = self._renditions.get(key)
+        if encoded is None and isinstance(self.image_data, ImageArchive):
+            encoded = self.image_data.get_rendition(image_id, rendition, img_format)
+        if encoded is None:
+            if isinstance(self.image_data, ImageArchive):
+                img_bytes, _ = self.image_data.get_bytes(image_id)
+                pil_img = Image.open(io.BytesIO(img_bytes))
+            else:
+                pil_img = Image.fromarray(self.image_data[image_id])
+            img_bytes = encode_rendition(pil_img, rendition, img_format)
+            encoded = (img_bytes, hashlib.sha1(img_bytes).hexdigest())
+            with self._lock:
+                self._renditions[key] = encoded
+        return encoded
+
+    def get_source_etag(self, image_id):
+        # etag of the stored image, without encoding it
+        if isinstance(self.image_data, ImageArchive):
+            return self.image_data.index[image_id][2]
+        etag = self._source_etags.get(image_id)
+        if etag is None:
+            array = self.image_data[image_id]
+            etag = hashlib.sha1(repr(array.shape).encode('utf-8') + array.tobytes()).hexdigest()
+            self._source_etags[image_id] = etag
+        return etag
+
+    @phase('image')
+    def get_data_uri(self, image_id, rendition=None):
+        key = (image_id, rendition)
+        data_uri = self._data_uris.get(key)
+        if data_uri is None:
+            if rendition:
+                img_format = rendition_formats[0]
+                img_bytes, _ = self.get_rendition(image_id, rendition, img_format)
+            else:
+                img_format = self.img_format
+                img_bytes, _ = self.get_bytes(image_id)
+            encoded = base64.b64encode(img_bytes).decode("utf-8")
+            data_uri = f"data:{img_mimetypes[img_format]};base64,{encoded}"
+            with self._lock:
+                self._data_uris[key] = data_uri
+        return data_uri
+
+    def get_url(self, image_id, rendition=None):
+        # the etag is part of the url, such that browsers can cache the image forever. The url of a rendition is
+        # versioned by the stored image and the rendition settings, the rendition itself is only encoded once requested.
+        if rendition:
+            version = hashlib.sha1(f'{self.get_source_etag(image_id)}{renditions[rendition]}'.encode('utf-8'))
+            return f"{self.url_prefix}/{image_id}?v={version.hexdigest()[:12]}&r={rendition}"
+        _, etag = self.get_bytes(image_id)
+        return f"{self.url_prefix}/{image_id}?v={etag[:12]}"
+
+    def get_src(self, image_id, rendition=None):
+        if self.url_prefix:
+            return self.get_url(image_id, rendition)
+        return self.get_data_uri(image_id, rendition)
+
+    def warm(self):
+        # encode all images upfront (e.g. at worker start), archives are encoded already
+        if isinstance(self.image_data, ImageArchive):
+            return
+        for image_id in self.image_data:
+            self.get_bytes(image_id)
+
+    def serve(self, image_id):
+        # serves the stored image, or the rendition given by the r parameter in the best format the browser accepts
+        rendition = request.args.get('r')
+        if image_id not in self or (rendition and rendition not in renditions):
+            abort(404)
+        if rendition:
+            # the format has to be accepted explicitly, old browsers accept */* without supporting WEBP
+            accepted = [mimetype for mimetype, quality in request.accept_mimetypes if quality > 0]
+            img_format = next((img_format for img_format in rendition_formats
+                               if img_mimetypes[img_format] in accepted), rendition_formats[-1])
+            img_bytes, etag = self.get_rendition(image_id, rendition, img_format)
+            mimetype = img_mimetypes[img_format]
+        else:
+            img_bytes, etag = self.get_bytes(image_id)
+            mimetype = self.mimetype
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(img_bytes, mimetype=mimetype)
+        if rendition:
+            response.vary.add('Accept')
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        return response
+
+
+def load_image_data(img_pth):
+    # image archives are memory mapped, legacy pickles are loaded completely. No path means no images.
+    if img_pth is None:
+        return {}
+    if img_pth.endswith('.pkl'):
+        with open(img_pth, 'rb') as f:
+            return pickle.load(f)
+    return ImageArchive(img_pth)
+
+
+def register_image_route(server, get_image_store, url_prefix='/images'):
+    # serve the encoded images of all countries as static, cacheable urls on the flask server
+    server.add_url_rule(
+        f'{url_prefix}/<cntry_code>/<image_id>', 'serve_image',
+        lambda cntry_code, image_id: get_image_store(cntry_code).serve(image_id)
+    )
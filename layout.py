@@ -90,13 +90,14 @@ def show_placeholder(base_style):
     return aux
 
 
-def generate_testimonial_box(image_id, text_id, reverse=False):
+def generate_testimonial_box(image_id, text_id, image_src=None, testimonial=None, reverse=False):
     image = html.Img(
         id=image_id,
+        src=image_src,
         style={'height': '100px', 'width': 'auto', 'padding': '5px'}
     )
     text = html.Div(
-        children=[html.Div(id=text_id, children=[])],
+        children=[html.Div(id=text_id, children=testimonial)],
         style={'flex': '1', 'padding': '10px'}
     )
     style = {
@@ -119,17 +120,36 @@ def generate_testimonial_box(image_id, text_id, reverse=False):
         return html.Div(children=[image, text], style=style)
 
 
+# poverty indicators that can be displayed on the map
+poverty_indicator_options = [
+    {'label': 'No indicator', 'value': 'no_indicator'},
+    {'label': 'Multidimensional poverty index', 'value': 'mpi_region'},
+    {'label': 'Multidimensional poverty headcount ratio', 'value': 'hr_poor'},
+    {'label': 'Severe poverty headcount ratio', 'value': 'hr_severe_poverty'}
+]
+
+
+# countries that can be selected, the data of a country is only loaded once it is selected for the first time
+country_options = [
+    {'label': 'Cambodia', 'value': 'KHM'},
+    {'label': 'Senegal', 'value': 'SEN'}
+]
+
+
 def create_poverty_indicator_dropdown():
     aux = html.Div(
         children=[
+            html.Div("Select a country", style={'padding': '3px'}),
+            dcc.Dropdown(
+                options=country_options,
+                value='KHM',
+                clearable=False,
+                id='country'
+            ),
             html.Div("Select a poverty indicator to be displayed on the map", style={'padding': '3px'}),
             # add the dropdown menu
             dcc.Dropdown(
-                options=[
-                    {'label': 'No indicator', 'value': 'no_indicator'},
-                    {'label': 'Multidimensional poverty index', 'value': 'mpi_region'},
-                    {'label': 'Multidimensional poverty headcount ratio', 'value': 'hr_poor'}
-                ],
+                options=poverty_indicator_options,
                 value='no_indicator',
                 id='poverty_indicator'
             )
@@ -149,6 +169,125 @@ entry_layout = html.Div([
     ),
     html.Div(id='output-container-button'),
 ])
+# --------------------------------- TABS -------------------------------------------------------------------------------
+# the tabs of a selected project. Only the content of the open tab is loaded, the other tabs are loaded once opened.
+project_tab_labels = {
+    'tab_0': 'Project description',
+    'tab_1': 'Before-After story',
+    'tab_2': 'Testimonials',
+    'tab_3': 'Project Progress'
+}
+
+
+def create_project_tabs():
+    return dcc.Tabs(
+        id='project_tabs',
+        value='tab_0',
+        children=[
+            dcc.Tab(value=value,
+                    label=label,
+                    children=[dcc.Loading(html.Div(id=f'{value}_content', children=[show_placeholder(base_style)]),
+                                          type='circle')],
+                    style=basic_tab_style,
+                    selected_style=selected_tab_style)
+            for value, label in project_tab_labels.items()
+        ]
+    )
+
+
+def create_description_tab(project_img, project_text):
+    return html.Div(
+        children=[
+            html.Img(id='project_img',
+                     src=project_img,
+                     style={'height': '200px', 'width': 'auto', 'padding': '5px'}),
+            html.Div(id='project_text',
+                     children=project_text,
+                     style={'flex': '1', 'padding': '10px'}),
+        ],
+        style=within_tab_style
+    )
+
+
+def create_before_after_tab(before_img, after_img, before_after_text):
+    return html.Div(
+        id='big_block',
+        children=[
+            html.Div(
+                id='first_block',
+                children=[
+                    html.H2(f"Before", style={'textAlign': 'center'}),
+                    html.Img(id='before_img',
+                             src=before_img,
+                             style={'height': '300px', 'width': 'auto', 'padding': '5px',
+                                    'margin': '0px auto'}),
+                ],
+                style={'width': '48%', 'display': 'inline-block', 'vertical-align': 'top',
+                       'text-align': 'center'}
+            ),
+            html.Div(
+                id='second_block',
+                children=[
+                    html.H2(f"After", style={'textAlign': 'center'}),
+                    html.Img(id='after_img',
+                             src=after_img,
+                             style={'height': '300px', 'width': 'auto', 'padding': '5px'}),
+                ],
+                style={'width': '48%', 'display': 'inline-block', 'vertical-align': 'top',
+                       'text-align': 'center'}
+            ),
+            html.Div(id='before_after_text', children=before_after_text,
+                     style={'padding': '20px'})
+        ],
+        style={'vertical-align': 'top',
+               'width': '95%',
+               'margin': '0px auto',
+               'margin-bottom': '20px',
+               'background-color': base_color}
+    )
+
+
+def create_testimonials_tab(testimonials):
+    return html.Div([
+        generate_testimonial_box('testimonial_img_1', 'testimonial_text_1', *testimonials[0:2]),
+        generate_testimonial_box('testimonial_img_2', 'testimonial_text_2', *testimonials[2:4], reverse=True),
+        generate_testimonial_box('testimonial_img_3', 'testimonial_text_3', *testimonials[4:6])
+    ])
+
+
+def create_progress_tab(progress_fig, dropdown_options, progress_series):
+    return html.Div(
+        children=[
+            dcc.Graph(id='progress_fig', figure=progress_fig),
+            # the series of all progress indicators, the figure is switched to another indicator in the browser
+            dcc.Store(id='progress_data', data=progress_series),
+            html.Div(
+                children=[
+                    html.Div("Select a progress indicator", style={'padding': '3px', 'left': '10px', 'right': '10px'}),
+                    # add the dropdown menu
+                    dcc.Dropdown(
+                        id='dropdown_options',
+                        options=dropdown_options,
+                        value='disbursement',
+                    )
+                ],
+                style={'position': 'absolute',
+                       'top': '70px',
+                       'left': '100px',
+                       'zIndex': '1000',
+                       'background-color': 'rgba(255, 255, 255, 0.8)',
+                       'color': overall_background_color,
+                       'padding': '10px',
+                       'border-radius': '5px',
+                       'width': '250px'}
+            )
+        ],
+        style={'position': 'relative',
+               'padding': '10px 10px 10px 10px',
+               'border-radius': '0px 0px 0px 0px'}
+    )
+
+
 # -------------------------------- BASE LAYOUT --------------------------------------------------------------------------
 base_layout = (
     html.Div(
@@ -175,10 +314,14 @@ base_layout = (
                        'width':'95%'}
             ),
 
+            # the project selected on the map and the tabs loaded for it
+            dcc.Store(id='selected_project'),
+            dcc.Store(id='loaded_tabs', data=[]),
+
             # add tabs to the dashboard, enabling the selection between stories and before and after images
             html.Div(
                 id='tabs',
-                children=[],
+                children=[create_project_tabs()],
                 style=outer_tab_style
             ),
 
@@ -205,138 +348,3 @@ base_layout = (
                'padding-top': '1px'}
     )
 )
-
-# --------------------------------- TABS -------------------------------------------------------------------------------
-
-empty_tabs = dcc.Tabs(
-    value='tab_0',
-    children=[
-        dcc.Tab(value='tab_0',
-                label='Project description',
-                children=[show_placeholder(base_style)],
-                style=basic_tab_style,
-                selected_style=selected_tab_style),
-        dcc.Tab(label='Before-After story',
-                children=[show_placeholder(base_style)],
-                style=basic_tab_style,
-                selected_style=selected_tab_style),
-        dcc.Tab(label='Testimonials',
-                children=[show_placeholder(base_style)],
-                style=basic_tab_style,
-                selected_style=selected_tab_style),
-        dcc.Tab(label='Project Progress',
-                children=[show_placeholder(base_style)],
-                style=basic_tab_style,
-                selected_style=selected_tab_style)
-    ]
-)
-
-filled_tabs = dcc.Tabs(
-    value='tab_0',
-    children=[
-        dcc.Tab(
-            value='tab_0',
-            label='Project description',
-            children=[
-                html.Div(
-                    children=[
-                        html.Img(id='project_img',
-                                 style={'height': '200px', 'width': 'auto', 'padding': '5px'}),
-                        html.Div(id='project_text',
-                                 children=[],
-                                 style={'flex': '1', 'padding': '10px'}),
-                    ],
-                    style=within_tab_style
-                )
-            ],
-            style=basic_tab_style,
-            selected_style=selected_tab_style
-        ),
-        dcc.Tab(
-            label='Before-After story',
-            children=[
-                html.Div(
-                    id='big_block',
-                    children=[
-                        html.Div(
-                            id='first_block',
-                            children=[
-                                html.H2(f"Before", style={'textAlign': 'center'}),
-                                html.Img(id='before_img',
-                                         style={'height': '300px', 'width': 'auto', 'padding': '5px',
-                                                'margin': '0px auto'}),
-                            ],
-                            style={'width': '48%', 'display': 'inline-block', 'vertical-align': 'top',
-                                   'text-align': 'center'}
-                        ),
-                        html.Div(
-                            id='second_block',
-                            children=[
-                                html.H2(f"After", style={'textAlign': 'center'}),
-                                html.Img(id='after_img',
-                                         style={'height': '300px', 'width': 'auto', 'padding': '5px'}),
-                            ],
-                            style={'width': '48%', 'display': 'inline-block', 'vertical-align': 'top',
-                                   'text-align': 'center'}
-                        ),
-                        html.Div(id='before_after_text', children=[],
-                                 style={'padding': '20px'})
-                    ],
-                    style={'vertical-align': 'top',
-                           'width': '95%',
-                           'margin': '0px auto',
-                           'margin-bottom': '20px',
-                           'background-color': base_color}
-                )
-            ],
-            style=basic_tab_style,
-            selected_style=selected_tab_style
-        ),
-        dcc.Tab(label='Testimonials',
-                children=[
-                    html.Div([
-                        generate_testimonial_box(image_id='testimonial_img_1', text_id='testimonial_text_1'),
-                        generate_testimonial_box(image_id='testimonial_img_2', text_id='testimonial_text_2', reverse=True),
-                        generate_testimonial_box(image_id='testimonial_img_3', text_id='testimonial_text_3')
-                    ])
-                ],
-                style=basic_tab_style,
-                selected_style=selected_tab_style
-        ),
-        dcc.Tab(
-            label='Project Progress',
-            children=[
-                html.Div(
-                    children=[
-                        dcc.Graph(id='progress_fig', figure={}),
-                        html.Div(
-                            children=[
-                                html.Div("Select a progress indicator", style={'padding': '3px', 'left': '10px', 'right': '10px'}),
-                                # add the dropdown menu
-                                dcc.Dropdown(
-                                    id='dropdown_options',
-                                    options=[],
-                                    value='disbursement',
-                                )
-                            ],
-                            style={'position': 'absolute',
-                                   'top': '70px',
-                                   'left': '100px',
-                                   'zIndex': '1000',
-                                   'background-color': 'rgba(255, 255, 255, 0.8)',
-                                   'color': overall_background_color,
-                                   'padding': '10px',
-                                   'border-radius': '5px',
-                                   'width': '250px'}
-                        )
-                    ],
-                    style={'position': 'relative',
-                           'padding': '10px 10px 10px 10px',
-                           'border-radius': '0px 0px 0px 0px'}
-                )
-            ],
-            style=basic_tab_style,
-            selected_style=selected_tab_style
-        )
-    ]
-)
@@ -0,0 +1,160 @@
+import os
+import time
+import random
+import cProfile
+import tempfile
+import functools
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+from flask import request, Response
+
+# upper bounds of the histogram buckets
+duration_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+size_buckets = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7)
+
+# callbacks are profiled with the given probability, the profiles are dumped into profile_dir
+profile_rate = float(os.environ.get('DASH_PROFILE_RATE', 0))
+profile_dir = os.environ.get('DASH_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'toy_dash_profiles'))
+
+
+# ------------------------------- Prometheus histograms ----------------------------------------------------------------
+class Histogram:
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = defaultdict(lambda: [[0] * len(buckets), 0, 0.0])
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            bucket_counts, _, _ = series = self._series[labels]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucket_counts[i] += 1
+            series[1] += 1
+            series[2] += value
+
+    def expose(self):
+        # text exposition format of prometheus, the bucket counts are cumulative
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, (bucket_counts, count, total) in sorted(self._series.items()):
+                label_str = ','.join(f'{name}="{value}"' for name, value in zip(self.label_names, labels))
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(f'{self.name}_bucket{{{label_str},le="{bound:g}"}} {bucket_count}')
+                lines.append(f'{self.name}_bucket{{{label_str},le="+Inf"}} {count}')
+                lines.append(f'{self.name}_count{{{label_str}}} {count}')
+                lines.append(f'{self.name}_sum{{{label_str}}} {total:.6f}')
+        return lines
+
+
+# the metrics are kept per worker process, the pid is exposed with them to tell the workers apart
+callback_seconds = Histogram('dash_callback_duration_seconds', 'Wall time of the callbacks', ('callback',),
+                             duration_buckets)
+phase_seconds = Histogram('dash_callback_phase_seconds',
+                          'Time spent in figure construction, image encoding and data lookup per callback',
+                          ('callback', 'phase'), duration_buckets)
+request_seconds = Histogram('dash_request_duration_seconds', 'Wall time of the requests, including the serialization',
+                            ('endpoint',), duration_buckets)
+response_bytes = Histogram('dash_response_size_bytes', 'Size of the serialized responses', ('endpoint',), size_buckets)
+compression_seconds = Histogram('dash_compression_duration_seconds', 'CPU time of the response compression',
+                                ('endpoint', 'encoding'), duration_buckets)
+compression_saved_bytes = Histogram('dash_compression_saved_bytes', 'Bytes saved by the compression of a response',
+                                    ('endpoint', 'encoding'), size_buckets)
+
+
+# ------------------------------- Callback instrumentation -------------------------------------------------------------
+# every thread keeps the name of the running callback and a stack of the open phases. The time of a phase excludes the
+# time of the phases nested in it, the time of a callback outside of any phase is recorded as phase 'other'.
+_local = threading.local()
+
+
+def current_callback():
+    return getattr(_local, 'callback', None)
+
+
+@contextmanager
+def phase(name):
+    # usable as context manager and as decorator: `with phase('figure'): ...` or `@phase('figure')`
+    stack = getattr(_local, 'phases', None)
+    if stack is None:
+        stack = _local.phases = []
+    frame = [0.0]
+    stack.append(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+        if stack:
+            stack[-1][0] += elapsed
+        phase_seconds.observe((current_callback() or 'none', name), elapsed - frame[0])
+
+
+def profile_call(name, func, *args):
+    # run a sampled call under cProfile, the dumps can be inspected with `python -m pstats <file>`
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(profile_dir, f'{name}-{os.getpid()}-{time.time_ns()}.prof'))
+
+
+def instrument(name):
+    # record the wall time and the phases of a callback under the given name
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            _local.callback = name
+            start = time.perf_counter()
+            try:
+                with phase('other'):
+                    if profile_rate and random.random() < profile_rate:
+                        return profile_call(name, func, *args)
+                    return func(*args)
+            finally:
+                callback_seconds.observe((name,), time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+# ------------------------------- Metrics endpoint ---------------------------------------------------------------------
+def expose_metrics():
+    lines = []
+    for histogram in (callback_seconds, phase_seconds, request_seconds, response_bytes, compression_seconds,
+                      compression_saved_bytes):
+        lines.extend(histogram.expose())
+    lines.append('# HELP dash_worker_pid Process id of the worker serving these metrics')
+    lines.append('# TYPE dash_worker_pid gauge')
+    lines.append(f'dash_worker_pid {os.getpid()}')
+    return Response('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def register_metrics(server, url='/metrics'):
+    # time every request and record the size of its response. Requests of dash callbacks are labelled with the name of
+    # the instrumented callback, all other requests with their flask endpoint.
+    def start_request():
+        _local.callback = None
+        _local.request_start = time.perf_counter()
+
+    def finish_request(response):
+        # the start is reset, such that requests rejected before start_request ran are not timed
+        start = getattr(_local, 'request_start', None)
+        _local.request_start = None
+        if start is None or request.path == url:
+            return response
+        endpoint = current_callback() or request.endpoint or 'unknown'
+        request_seconds.observe((endpoint,), time.perf_counter() - start)
+        if not response.direct_passthrough:
+            response_bytes.observe((endpoint,), response.calculate_content_length() or 0)
+        return response
+
+    server.before_request(start_request)
+    server.after_request(finish_request)
+    server.add_url_rule(url, 'metrics', expose_metrics)
@@ -0,0 +1,127 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from cache import file_signature
+from metrics import phase
+
+logger = logging.getLogger(__name__)
+
+
+# Registry of the loaded countries. The data of a country is loaded the first time the country is requested and kept
+# for the next requests. Only the maxsize most recently used countries are kept in memory.
+# The data of a country consists of datasets, get_datasets(cntry_code) returns them as
+#   {name: {'sources': [source files], 'load': function(current country or None) -> dict of entries of the country}}
+# The registry remembers the signature of the sources of every dataset. If the sources of a dataset change, only this
+# dataset is loaded again and swapped in, callbacks in flight keep working on the previous data of the country.
+class CountryRegistry:
+    def __init__(self, get_datasets, maxsize=4):
+        self.get_datasets = get_datasets
+        self.maxsize = maxsize
+        self._countries = OrderedDict()
+        self._datasets = {}
+        self._lock = threading.Lock()
+        self._loading_locks = {}
+        self._watcher = None
+        self._watcher_pid = None
+
+    def __contains__(self, cntry_code):
+        return cntry_code in self._countries
+
+    def _loading_lock(self, cntry_code):
+        with self._lock:
+            return self._loading_locks.setdefault(cntry_code, threading.Lock())
+
+    @phase('load')
+    def _load(self, cntry_code):
+        datasets = self.get_datasets(cntry_code)
+        country = {'cntry_code': cntry_code, 'versions': {}}
+        for name, dataset in datasets.items():
+            # the signature is taken before loading, such that a change during the load is picked up by the next poll
+            country['versions'][name] = file_signature(dataset['sources'])
+            country.update(dataset['load'](None))
+        self._datasets[cntry_code] = datasets
+        return country
+
+    def get(self, cntry_code):
+        with self._lock:
+            country = self._countries.get(cntry_code)
+            if country is not None:
+                self._countries.move_to_end(cntry_code)
+                return country
+            loading_lock = self._loading_locks.setdefault(cntry_code, threading.Lock())
+
+        # load the country outside of the registry lock, such that other countries can be served meanwhile. Concurrent
+        # requests for the same country wait for the first one to finish loading.
+        with loading_lock:
+            country = self._countries.get(cntry_code)
+            if country is None:
+                country = self._load(cntry_code)
+                with self._lock:
+                    self._countries[cntry_code] = country
+                    while len(self._countries) > self.maxsize:
+                        evicted, _ = self._countries.popitem(last=False)
+                        self._datasets.pop(evicted, None)
+        return country
+
+    def loaded(self):
+        with self._lock:
+            return list(self._countries)
+
+    def versions(self, cntry_code, names):
+        # signatures of the given datasets as loaded, cached results computed from them are keyed by these
+        versions = self.get(cntry_code)['versions']
+        return tuple(versions[name] for name in names)
+
+    # ------------------------------- Hot reload -----------------------------------------------------------------------
+    def refresh(self):
+        # reload the datasets whose sources changed since they were loaded, returns the reloaded (cntry_code, name)
+        reloaded = []
+        for cntry_code in self.loaded():
+            with self._loading_lock(cntry_code):
+                country = self._countries.get(cntry_code)
+                datasets = self._datasets.get(cntry_code)
+                if country is None or datasets is None:
+                    continue
+
+                for name, dataset in datasets.items():
+                    try:
+                        version = file_signature(dataset['sources'])
+                        if version == country['versions'][name]:
+                            continue
+                        entries = dataset['load'](country)
+                    except Exception:
+                        # e.g. a file that is written right now, the current data is kept and the next poll retries
+                        logger.exception('reloading %s of %s failed', name, cntry_code)
+                        continue
+                    # build a new country dict instead of updating the current one, such that callbacks in flight
+                    # never see a half reloaded country
+                    country = {**country, **entries, 'versions': {**country['versions'], name: version}}
+                    reloaded.append((cntry_code, name))
+
+                with self._lock:
+                    if cntry_code in self._countries:
+                        self._countries[cntry_code] = country
+        for cntry_code, name in reloaded:
+            logger.info('reloaded %s of %s', name, cntry_code)
+        return reloaded
+
+    def watch(self, interval=5):
+        # poll the sources of the loaded countries every interval seconds in a background thread. Safe to call on every
+        # request: the thread is started once per process, also in workers forked after the registry was created.
+        if not interval or (self._watcher_pid == os.getpid() and self._watcher.is_alive()):
+            return
+        with self._lock:
+            if self._watcher_pid == os.getpid() and self._watcher.is_alive():
+                return
+
+            def poll():
+                while True:
+                    time.sleep(interval)
+                    self.refresh()
+
+            self._watcher = threading.Thread(target=poll, name='country-registry-watcher', daemon=True)
+            self._watcher_pid = os.getpid()
+            self._watcher.start()
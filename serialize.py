@@ -0,0 +1,101 @@
+import os
+import base64
+import datetime
+import itertools
+
+import numpy as np
+import orjson
+from flask import g, request, has_request_context
+
+from metrics import phase
+
+# numeric arrays are sent as base64 encoded typed arrays with DASH_TYPED_ARRAYS=1. This needs plotly.js 2.28 or newer in
+# the browser, older versions (e.g. the 2.24 of dash 2.14) do not decode them.
+typed_arrays = os.environ.get('DASH_TYPED_ARRAYS', '0') == '1'
+
+# dtypes of the typed arrays of plotly.js, 64 bit integers are not supported and sent as int32 or float64
+typed_array_dtypes = {'float64': 'f8', 'float32': 'f4', 'int8': 'i1', 'uint8': 'u1', 'int16': 'i2', 'uint16': 'u2',
+                      'int32': 'i4', 'uint32': 'u4'}
+
+
+# ------------------------------- Fast figure encoder ------------------------------------------------------------------
+# orjson encodes the numpy arrays of a figure directly, instead of converting them element by element like the json
+# encoder of plotly. Everything orjson does not know is handed to default.
+def _default(obj):
+    if hasattr(obj, 'to_plotly_json'):
+        return obj.to_plotly_json()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+def to_typed_array(array):
+    if array.dtype == np.int64 or array.dtype == np.uint64:
+        in_range = not len(array) or (array.min() >= np.iinfo(np.int32).min and array.max() <= np.iinfo(np.int32).max)
+        array = array.astype(np.int32 if in_range else np.float64)
+    dtype = typed_array_dtypes.get(array.dtype.name)
+    if dtype is None or array.ndim != 1:
+        return array
+    return {'dtype': dtype, 'bdata': base64.b64encode(np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+                                                      .tobytes()).decode('ascii')}
+
+
+def with_typed_arrays(obj):
+    if isinstance(obj, dict):
+        return {key: with_typed_arrays(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [with_typed_arrays(value) for value in obj]
+    if isinstance(obj, np.ndarray):
+        return to_typed_array(obj)
+    return obj
+
+
+@phase('serialize')
+def dumps_figure(fig_dict, typed=None):
+    # the json bytes of a figure dict (fig.to_dict()), optionally with the numeric arrays as typed arrays
+    if typed_arrays if typed is None else typed:
+        fig_dict = with_typed_arrays(fig_dict)
+    return orjson.dumps(fig_dict, default=_default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+# ------------------------------- Pre-serialized responses -------------------------------------------------------------
+# Callback outputs which are already serialized, e.g. the cached figures. Dash serializes the response of a callback
+# itself, a RawJSON in it is serialized as a placeholder, which is replaced with the bytes once the response is built.
+# Hence the cached bytes are never decoded and encoded again.
+_tokens = itertools.count()
+
+
+class RawJSON:
+    __slots__ = ['json_bytes']
+
+    def __init__(self, json_bytes):
+        self.json_bytes = json_bytes
+
+    def to_plotly_json(self):
+        if not has_request_context():
+            # e.g. exported with build.py, without a response to splice the bytes into
+            return orjson.loads(self.json_bytes)
+        token = f'__raw_json_{os.getpid()}_{next(_tokens)}__'
+        if 'raw_json' not in g:
+            g.raw_json = {}
+        g.raw_json[token] = self.json_bytes
+        return token
+
+
+def register_raw_json(server):
+    # register after the other after_request hooks (e.g. register_metrics), flask runs them in reverse order
+    def splice_raw_json(response):
+        raw_json = g.pop('raw_json', None)
+        if not raw_json or response.direct_passthrough or request.method != 'POST':
+            return response
+        body = response.get_data()
+        for token, json_bytes in raw_json.items():
+            body = body.replace(f'"{token}"'.encode('ascii'), json_bytes, 1)
+        response.set_data(body)
+        return response
+
+    server.after_request(splice_raw_json)
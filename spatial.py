@@ -0,0 +1,95 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+from metrics import phase
+
+# size of the map in pixels, used to estimate the visible area if the map does not report it
+map_size_px = (1000, 450)
+# number of cluster cells per 256px map tile, i.e. clusters are roughly 64px apart
+cells_per_tile = 4
+
+
+def get_viewport(relayoutData, map_size=map_size_px):
+    # returns the visible bounds (min_lon, min_lat, max_lon, max_lat) and the zoom of the map, None if the relayout
+    # event does not concern the map view (e.g. the initial autosize)
+    if not relayoutData or 'mapbox.zoom' not in relayoutData:
+        return None
+    zoom = relayoutData['mapbox.zoom']
+
+    derived = relayoutData.get('mapbox._derived')
+    if derived and 'coordinates' in derived:
+        lons = [c[0] for c in derived['coordinates']]
+        lats = [c[1] for c in derived['coordinates']]
+        return (min(lons), min(lats), max(lons), max(lats)), zoom
+
+    # estimate the bounds from the center, a 256px tile covers 360 / 2^zoom degrees
+    center = relayoutData['mapbox.center']
+    deg_per_px = 360 / (256 * 2 ** zoom)
+    half_width = deg_per_px * map_size[0] / 2
+    half_height = deg_per_px * map_size[1] / 2
+    return (center['lon'] - half_width, center['lat'] - half_height,
+            center['lon'] + half_width, center['lat'] + half_height), zoom
+
+
+# Grid index over the project coordinates. The projects are bucketed into cells of cell_size degrees, such that a
+# viewport query only touches the projects of the overlapping cells.
+class GridIndex:
+    def __init__(self, project_df, cell_size=0.5, max_cluster_zoom=11, max_markers=200):
+        self.project_df = project_df.reset_index(drop=True)
+        self.lat = self.project_df['lat'].to_numpy(dtype=float)
+        self.lon = self.project_df['lon'].to_numpy(dtype=float)
+        self.cell_size = cell_size
+        # from this zoom level on, or if at most max_markers projects are visible, all projects are shown individually
+        self.max_cluster_zoom = max_cluster_zoom
+        self.max_markers = max_markers
+
+        cell_x = np.floor(self.lon / cell_size).astype(np.int64)
+        cell_y = np.floor(self.lat / cell_size).astype(np.int64)
+        self.cells = pd.Series(np.arange(len(self.project_df))).groupby([cell_x, cell_y]).indices
+
+    def __len__(self):
+        return len(self.project_df)
+
+    def query(self, bounds):
+        # returns the positions of all projects within the bounds
+        min_lon, min_lat, max_lon, max_lat = bounds
+        x0, x1 = math.floor(min_lon / self.cell_size), math.floor(max_lon / self.cell_size)
+        y0, y1 = math.floor(min_lat / self.cell_size), math.floor(max_lat / self.cell_size)
+
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+            # the viewport covers more cells than are occupied, check the occupied cells instead
+            candidates = [idx for (x, y), idx in self.cells.items() if x0 <= x <= x1 and y0 <= y <= y1]
+        else:
+            candidates = [self.cells[(x, y)] for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)
+                          if (x, y) in self.cells]
+        if not candidates:
+            return np.array([], dtype=np.int64)
+
+        idx = np.sort(np.concatenate(candidates))
+        lat, lon = self.lat[idx], self.lon[idx]
+        return idx[(lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat)]
+
+    @phase('lookup')
+    def cluster(self, bounds, zoom):
+        # returns the projects shown individually and the clusters (lat, lon, count) of the visible projects
+        idx = self.query(bounds)
+        clusters = pd.DataFrame({'lat': [], 'lon': [], 'count': []})
+        if zoom >= self.max_cluster_zoom or len(idx) <= self.max_markers:
+            return self.project_df.iloc[idx], clusters
+
+        # projects within the same cluster cell are merged, the cells get smaller with every zoom level
+        size = 360 / 2 ** zoom / cells_per_tile
+        cell_xy = np.stack([np.floor(self.lon[idx] / size), np.floor(self.lat[idx] / size)], axis=1)
+        _, inverse, counts = np.unique(cell_xy, axis=0, return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+
+        single = counts[inverse] == 1
+        multi = counts > 1
+        clusters = pd.DataFrame({
+            'lat': (np.bincount(inverse, weights=self.lat[idx]) / counts)[multi],
+            'lon': (np.bincount(inverse, weights=self.lon[idx]) / counts)[multi],
+            'count': counts[multi]
+        })
+        return self.project_df.iloc[idx[single]], clusters
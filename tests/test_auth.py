@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import datetime
+
+import pytest
+from flask import Flask
+from itsdangerous import URLSafeTimedSerializer
+
+from auth import CredentialStore, load_secret_key, register_session_auth
+
+secret_key = 'test-key'
+
+
+@pytest.fixture
+def credentials(tmp_path):
+    credentials = CredentialStore(str(tmp_path / 'credentials.json'))
+    credentials.set_password('alice', 'wonderland')
+    credentials.set_password('bob', 'builder')
+    return credentials
+
+
+def make_client(credentials, **kwargs):
+    server = Flask(__name__)
+    register_session_auth(server, credentials, secret_key, **kwargs)
+    server.add_url_rule('/', 'index', lambda: 'index')
+    server.add_url_rule('/_dash-layout', 'layout', lambda: '{}')
+    server.add_url_rule('/metrics', 'metrics', lambda: 'metrics')
+    server.add_url_rule('/assets/style.css', 'style', lambda: 'css')
+    server.add_url_rule('/_dash-component-suites/dash/dash.js', 'suite', lambda: 'js')
+    return server.test_client()
+
+
+def login(client, user='alice', password='wonderland', next_url=None):
+    url = '/login' if next_url is None else f'/login?next={next_url}'
+    return client.post(url, data={'username': user, 'password': password})
+
+
+def test_login(credentials):
+    client = make_client(credentials)
+    assert client.get('/_dash-layout').status_code == 401
+    assert login(client, password='wrong').status_code == 401
+    assert login(client, user='mallory').status_code == 401
+    assert login(client).status_code == 302
+    assert client.get('/_dash-layout').status_code == 200
+    client.get('/logout')
+    assert client.get('/_dash-layout').status_code == 401
+
+
+def test_pages_redirect_to_login(credentials):
+    client = make_client(credentials)
+    response = client.get('/?tab=1', headers={'Accept': 'text/html'})
+    assert response.status_code == 302
+    assert response.headers['Location'] == '/login?next=/%3Ftab%3D1'
+
+
+def test_public_prefixes(credentials):
+    client = make_client(credentials)
+    for path in ['/login', '/assets/style.css', '/_dash-component-suites/dash/dash.js']:
+        assert client.get(path).status_code == 200
+    for path in ['/', '/metrics', '/_dash-layout']:
+        assert client.get(path).status_code == 401
+
+
+@pytest.mark.parametrize('next_url, location', [
+    ('/page%3Fa%3D1', '/page?a=1'),
+    ('//evil.example', '/'),
+    ('https://evil.example/', '/'),
+    ('evil', '/'),
+])
+def test_next_redirect(credentials, next_url, location):
+    response = login(make_client(credentials), next_url=next_url)
+    assert response.status_code == 302
+    assert response.headers['Location'] == location
+
+
+def test_tampered_cookie(credentials):
+    client = make_client(credentials)
+    login(client, user='bob', password='builder')
+    token = client.get_cookie('dash_session').value
+
+    # another user in the payload, and a cookie signed with another key
+    rest = token.split('.', 1)[1]
+    forged = URLSafeTimedSerializer(secret_key, salt='dash-session').dumps('alice').split('.', 1)[0]
+    client.set_cookie('dash_session', f'{forged}.{rest}')
+    assert client.get('/_dash-layout').status_code == 401
+    client.set_cookie('dash_session', URLSafeTimedSerializer('other-key', salt='dash-session').dumps('alice'))
+    assert client.get('/_dash-layout').status_code == 401
+    client.set_cookie('dash_session', token)
+    assert client.get('/_dash-layout').status_code == 200
+
+
+def test_expired_cookie(credentials):
+    client = make_client(credentials, lifetime=datetime.timedelta(seconds=1))
+    login(client)
+    assert client.get('/_dash-layout').status_code == 200
+    time.sleep(2.1)
+    assert client.get('/_dash-layout').status_code == 401
+
+
+def test_removed_user(credentials):
+    client = make_client(credentials)
+    login(client)
+    assert client.get('/_dash-layout').status_code == 200
+
+    with open(credentials.credentials_pth) as f:
+        users = json.load(f)['users']
+    del users['alice']
+    with open(credentials.credentials_pth, 'w') as f:
+        json.dump({'users': users}, f)
+    assert client.get('/_dash-layout').status_code == 401
+
+
+def test_metrics_token(credentials):
+    client = make_client(credentials, bearer_tokens={'/metrics': 'scrape'})
+    assert client.get('/metrics', headers={'Authorization': 'Bearer scrape'}).status_code == 200
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    # the token is only valid for its path
+    assert client.get('/_dash-layout', headers={'Authorization': 'Bearer scrape'}).status_code == 401
+
+
+def test_load_secret_key(tmp_path):
+    key_pth = str(tmp_path / 'secret.key')
+    secret = load_secret_key(key_pth)
+    assert len(secret) == 64
+    assert os.stat(key_pth).st_mode & 0o777 == 0o600
+    assert load_secret_key(key_pth) == secret
+
+    # a key file readable by others, or a link to another file, is refused
+    os.chmod(key_pth, 0o644)
+    with pytest.raises(PermissionError):
+        load_secret_key(key_pth)
+    link_pth = str(tmp_path / 'link.key')
+    os.symlink(key_pth, link_pth)
+    with pytest.raises(OSError):
+        load_secret_key(link_pth)
@@ -0,0 +1,128 @@
+import os
+import time
+
+import pytest
+
+from cache import CallbackCache, MemoryBackend, SQLiteBackend, atomic_write, private_dir
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_cache(request, tmp_path):
+    def make(maxsize=1024, ttl=None):
+        if request.param == 'memory':
+            return CallbackCache(MemoryBackend(maxsize=maxsize, ttl=ttl))
+        # every access is written, such that the LRU order is exact
+        return CallbackCache(SQLiteBackend(str(tmp_path / 'cache.sqlite'), maxsize=maxsize, ttl=ttl,
+                                           touch_interval=0))
+    return make
+
+
+def test_hits_and_misses(make_cache):
+    cache = make_cache()
+    calls = []
+
+    @cache.memoize('square')
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    assert [square(2), square(2), square(3), square(2)] == [4, 4, 9, 4]
+    assert calls == [2, 3]
+    assert cache.stats() == {'square': {'hits': 2, 'misses': 2, 'waits': 0}}
+
+
+def test_source_change_invalidates(make_cache, tmp_path):
+    cache = make_cache()
+    source_pth = tmp_path / 'source.csv'
+    source_pth.write_text('a')
+
+    @cache.memoize('read', sources=[str(source_pth)])
+    def read():
+        return source_pth.read_text()
+
+    assert read() == 'a'
+    source_pth.write_text('ab')
+    assert read() == 'ab'
+    assert cache.stats()['read']['misses'] == 2
+
+
+def test_ttl_expiry(make_cache):
+    cache = make_cache(ttl=0.2)
+    calls = []
+
+    @cache.memoize('value')
+    def value(x):
+        calls.append(x)
+        return x
+
+    value(1)
+    value(1)
+    assert calls == [1]
+    time.sleep(0.3)
+    value(1)
+    assert calls == [1, 1]
+
+
+def test_lru_trimming(make_cache):
+    cache = make_cache(maxsize=2)
+    calls = []
+
+    @cache.memoize('value')
+    def value(x):
+        calls.append(x)
+        return x
+
+    value(1)
+    time.sleep(0.01)
+    value(2)
+    time.sleep(0.01)
+    # 1 is used again, hence 2 is the least recently used entry once 3 is added
+    value(1)
+    time.sleep(0.01)
+    value(3)
+    calls.clear()
+    value(1)
+    value(3)
+    assert calls == []
+    value(2)
+    assert calls == [2]
+
+
+def test_sqlite_touch_interval(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'cache.sqlite'), maxsize=2, touch_interval=60)
+    backend.set('a', 1)
+    backend.set('b', 2)
+    # the access of a is not written within the touch interval, it stays the least recently used entry
+    assert backend.get('a') == (True, 1)
+    backend.set('c', 3)
+    assert backend.get('a') == (False, None)
+    assert backend.get('b') == (True, 2)
+
+
+def test_private_dir(tmp_path):
+    pth = private_dir(str(tmp_path), 'cache')
+    assert os.stat(pth).st_mode & 0o777 == 0o700
+    assert private_dir(str(tmp_path), 'cache') == pth
+
+    # a directory planted by someone else (or opened up to others) is refused
+    os.chmod(pth, 0o777)
+    with pytest.raises(PermissionError):
+        private_dir(str(tmp_path), 'cache')
+    os.symlink(str(tmp_path), os.path.join(str(tmp_path), f'link-{os.getuid()}'))
+    with pytest.raises(PermissionError):
+        private_dir(str(tmp_path), 'link')
+
+
+def test_atomic_write(tmp_path):
+    pth = str(tmp_path / 'data.json')
+    with atomic_write(pth) as tmp_pth, open(tmp_pth, 'w') as f:
+        f.write('old')
+
+    # a failed write keeps the previous file and leaves no temporary file behind
+    with pytest.raises(ValueError):
+        with atomic_write(pth) as tmp_pth, open(tmp_pth, 'w') as f:
+            f.write('half')
+            raise ValueError()
+    with open(pth) as f:
+        assert f.read() == 'old'
+    assert os.listdir(str(tmp_path)) == ['data.json']
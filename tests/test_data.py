@@ -0,0 +1,118 @@
+import pandas as pd
+import pytest
+
+import data
+from data import match_regions, import_indicator_df, append_indicator_df, cached_load
+
+indicator_header = ('project_id,date,indicator_1,indicator_2,indicator_name_1,indicator_name_2,disbursement,'
+                    'disbursement_description\n')
+
+
+# ------------------------------- Region matching ----------------------------------------------------------------------
+def test_match_regions():
+    geodata = pd.DataFrame({
+        'GID_1': ['KHM.1_1', 'KHM.2_1', 'KHM.3_1', 'KHM.4_1'],
+        'NAME_1': ['Kâmpóng Cham', 'Batdâmbâng', 'Otdar Mean Chey', 'Pailin'],
+        'VARNAME_1': ['NA', 'Battambang|Batdambang', 'NA', 'NA']
+    })
+    mpi_df = pd.DataFrame({'subnational_region': ['Kampong cham', 'Battambang', 'Oddar Meanchey', 'Kep']})
+    aliases = pd.DataFrame({'GID_1': ['KHM.3_1'], 'subnational_region': ['Oddar Meanchey']})
+
+    with pytest.warns(UserWarning, match='unmatched'):
+        names = match_regions(geodata, mpi_df, aliases, 'KHM')
+    # matched by the normalized name, a variant name and the alias, Pailin has no MPI data
+    assert list(names[:3]) == ['Kampong cham', 'Battambang', 'Oddar Meanchey']
+    assert pd.isna(names[3])
+
+
+def test_match_regions_alias_first():
+    geodata = pd.DataFrame({'GID_1': ['A.1_1'], 'NAME_1': ['North'], 'VARNAME_1': ['NA']})
+    mpi_df = pd.DataFrame({'subnational_region': ['North', 'Northern Province']})
+    aliases = pd.DataFrame({'GID_1': ['A.1_1'], 'subnational_region': ['Northern Province']})
+
+    with pytest.warns(UserWarning):
+        names = match_regions(geodata, mpi_df, aliases)
+    assert list(names) == ['Northern Province']
+
+
+# ------------------------------- Indicator ingestion ------------------------------------------------------------------
+def test_append_indicator_df(tmp_path):
+    indicator_pth = tmp_path / 'indicators.csv'
+    indicator_pth.write_text(indicator_header +
+                             'p1,2020-01-01,1,2,meters,tons,100,start\n'
+                             'p2,2020-01-01,5,0,meters,tons,50,\n')
+    indicator_df = import_indicator_df(str(indicator_pth))
+
+    with open(indicator_pth, 'a') as f:
+        f.write('p1,2020-02-01,3,4,meters,tons,200,\n'
+                'p3,2020-01-01,7,1,wells,tons,10,new\n')
+    appended = append_indicator_df(indicator_df, str(indicator_pth))
+
+    expected = import_indicator_df(str(indicator_pth))
+    pd.testing.assert_frame_equal(appended, expected)
+    assert appended.attrs == expected.attrs
+    assert appended.loc[appended.project_id == 'p1', 'disbursement_total'].tolist() == [100, 300]
+
+
+def test_append_indicator_df_unchanged(tmp_path):
+    indicator_pth = tmp_path / 'indicators.csv'
+    indicator_pth.write_text(indicator_header + 'p1,2020-01-01,1,2,meters,tons,100,start\n')
+    indicator_df = import_indicator_df(str(indicator_pth))
+
+    appended = append_indicator_df(indicator_df, str(indicator_pth))
+    pd.testing.assert_frame_equal(appended, indicator_df)
+
+
+def test_append_indicator_df_rewritten(tmp_path):
+    # a file which was not only appended to has to be imported again
+    indicator_pth = tmp_path / 'indicators.csv'
+    indicator_pth.write_text(indicator_header + 'p1,2020-01-01,1,2,meters,tons,100,start\n')
+    indicator_df = import_indicator_df(str(indicator_pth))
+
+    indicator_pth.write_text(indicator_header + 'p1,2020-01-01,9,2,meters,tons,100,start\n'
+                                                'p1,2020-02-01,3,4,meters,tons,200,\n')
+    assert append_indicator_df(indicator_df, str(indicator_pth)) is None
+    indicator_pth.write_text(indicator_header)
+    assert append_indicator_df(indicator_df, str(indicator_pth)) is None
+
+
+def test_append_indicator_df_partial_row(tmp_path):
+    # a row the writer is still appending is ingested once it is complete
+    indicator_pth = tmp_path / 'indicators.csv'
+    indicator_pth.write_text(indicator_header + 'p1,2020-01-01,1,2,meters,tons,100,start\np1,2020-02-01,3')
+    indicator_df = import_indicator_df(str(indicator_pth))
+    assert len(indicator_df) == 1
+    assert indicator_df.attrs['source_offset'] == indicator_pth.read_bytes().rfind(b'\n') + 1
+
+    with open(indicator_pth, 'a') as f:
+        f.write(',4')
+    partial = append_indicator_df(indicator_df, str(indicator_pth))
+    pd.testing.assert_frame_equal(partial, indicator_df)
+    assert partial.attrs == indicator_df.attrs
+
+    with open(indicator_pth, 'a') as f:
+        f.write(',meters,tons,200,\n')
+    appended = append_indicator_df(partial, str(indicator_pth))
+    pd.testing.assert_frame_equal(appended, import_indicator_df(str(indicator_pth)))
+    assert appended.indicator_2.tolist() == [2, 4]
+    assert appended.disbursement_total.tolist() == [100, 300]
+
+
+# ------------------------------- Startup snapshot ---------------------------------------------------------------------
+def test_snapshot_version(tmp_path, monkeypatch):
+    source_pth = tmp_path / 'source.csv'
+    source_pth.write_text('a\n1\n')
+    snapshot_pth = str(tmp_path / 'snapshot')
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return pd.read_csv(source_pth)
+
+    cached_load('source', loader, [str(source_pth)], snapshot_pth)
+    cached_load('source', loader, [str(source_pth)], snapshot_pth)
+    assert len(calls) == 1
+    # a snapshot written by other loaders is parsed again, although its sources are unchanged
+    monkeypatch.setattr(data, 'snapshot_version', data.snapshot_version + 1)
+    cached_load('source', loader, [str(source_pth)], snapshot_pth)
+    assert len(calls) == 2
@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+
+from spatial import GridIndex, get_viewport
+
+
+def random_projects(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'project_id': [f'p{i}' for i in range(n)],
+                         'lat': rng.uniform(10, 14.5, n), 'lon': rng.uniform(102.5, 107.5, n)})
+
+
+def test_query_matches_scan():
+    project_df = random_projects()
+    index = GridIndex(project_df)
+    for bounds in [(104, 11, 105, 12), (103.21, 10.05, 103.22, 14.4), (102, 9, 108, 15), (110, 0, 111, 1),
+                   (104.5, 12.5, 104.5, 12.5)]:
+        min_lon, min_lat, max_lon, max_lat = bounds
+        expected = np.flatnonzero((project_df.lon >= min_lon) & (project_df.lon <= max_lon) &
+                                  (project_df.lat >= min_lat) & (project_df.lat <= max_lat))
+        assert index.query(bounds).tolist() == expected.tolist()
+
+
+def test_cluster_counts_every_visible_project():
+    index = GridIndex(random_projects(), max_markers=50)
+    bounds = (103, 10.5, 106, 13.5)
+    single, clusters = index.cluster(bounds, zoom=7)
+    assert len(clusters) > 0
+    assert (clusters['count'] > 1).all()
+    assert len(single) + clusters['count'].sum() == len(index.query(bounds))
+
+
+def test_cluster_shows_all_projects_when_zoomed_in_or_few():
+    index = GridIndex(random_projects(), max_markers=50, max_cluster_zoom=11)
+    bounds = (103, 10.5, 106, 13.5)
+    single, clusters = index.cluster(bounds, zoom=11)
+    assert len(single) == len(index.query(bounds)) and clusters.empty
+
+    small_bounds = (104, 11, 104.1, 11.1)
+    single, clusters = index.cluster(small_bounds, zoom=7)
+    assert len(single) == len(index.query(small_bounds)) <= 50 and clusters.empty
+
+
+def test_get_viewport():
+    assert get_viewport(None) is None
+    assert get_viewport({'autosize': True}) is None
+    derived = {'coordinates': [[103, 13], [106, 13], [106, 11], [103, 11]]}
+    assert get_viewport({'mapbox.zoom': 7, 'mapbox._derived': derived}) == ((103, 11, 106, 13), 7)
+    (min_lon, min_lat, max_lon, max_lat), zoom = get_viewport(
+        {'mapbox.zoom': 8, 'mapbox.center': {'lon': 105, 'lat': 12}}, map_size=(512, 256))
+    assert zoom == 8
+    assert np.allclose([min_lon, max_lon, min_lat, max_lat], [103.59375, 106.40625, 11.296875, 12.703125])